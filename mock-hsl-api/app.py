@@ -1,5 +1,6 @@
 # coding=utf-8
 import datetime
+import json
 import re
 import time
 from flask import Flask
@@ -9,10 +10,42 @@ from waitress import serve
 app = Flask(__name__)
 
 
+def trip_query(trip_id):
+    # Same as TRIP_QUERY in services.py
+    return '{trip(id: "%s") {  gtfsId  stoptimesForDate(serviceDay: "%s") {      stop {          gtfsId          name          code      }      serviceDay      realtimeArrival      arrivalDelay  }}}' % (
+        trip_id, datetime.datetime.now().strftime("%Y%m%d"))
+
+
+def stop_query(stop_id):
+    # Same as STOP_QUERY with STOP_SCHEDULE_FIELDS in services.py
+    return '{stop(id: "%s") {  name  code  vehicleType  stoptimesForServiceDate(date: "%s"){     pattern {         code         name         directionId         route {             gtfsId             longName             shortName         }     }     stoptimes {         trip{             gtfsId         }         stopHeadsign         serviceDay    	    realtimeArrival      }    }  }}' % (
+        stop_id, datetime.datetime.now().strftime("%Y%m%d"))
+
+
 @app.route('/', methods=['POST'])
 def mock():
     request_body = request.data.decode('utf-8')
 
+    # Trips selected under aliases t<index>, same as trips_query in services.py
+    trip_ids = re.findall(r't\d+: trip\(id: "([^"]*)"\)', request_body)
+    if trip_ids:
+        trips = {}
+        for i, trip_id in enumerate(trip_ids):
+            trips["t%d" % i] = json.loads(respond(trip_query(trip_id))).get("data", {}).get("trip")
+        return json.dumps({"data": trips})
+
+    # Stops selected under aliases s<index>, same as stops_query in services.py
+    stop_ids = re.findall(r's\d+: stop\(id: "([^"]*)"\)', request_body)
+    if stop_ids:
+        stops = {}
+        for i, stop_id in enumerate(stop_ids):
+            stops["s%d" % i] = json.loads(respond(stop_query(stop_id))).get("data", {}).get("stop")
+        return json.dumps({"data": stops})
+
+    return respond(request_body)
+
+
+def respond(request_body):
     if request_body == '{stopsByRadius(lat:60.293571, lon:25.044250, radius:1) {  edges {      node {          distance          stop {    	        gtfsId              name              vehicleType          }      }    }  }}':
         return '''
 {
@@ -5498,7 +5531,7 @@ def mock():
 }
         ''')
     
-    elif request_body == '{trip(id: "HSL:1506_20161031_Ti_2_1155") { stoptimesForDate(serviceDay: "%s") {      stop{          gtfsId          name          code }      serviceDay      realtimeArrival        }       }      }}' % (datetime.datetime.now().strftime("%Y%m%d")):
+    elif request_body == trip_query("HSL:1506_20161031_Ti_2_1155"):
         return re.sub(r'"serviceDay":.*,',
                       '"serviceDay": ' + str(int(time.mktime(time.strptime(datetime.datetime.now().strftime("%Y%m%d"), "%Y%m%d")))) + ",",
                       '''
@@ -5773,7 +5806,7 @@ def mock():
 }
         ''')
 
-    elif request_body == '{ trip(id:\"trip_id_1\"){\n                        gtfsId\n                        stoptimesForDate(serviceDay:"%s"){\n                            serviceDay\n                            realtimeArrival\n                            stop{\n                                gtfsId\n                            }\n                            }\n                        }\n                    }'  % (datetime.datetime.now().strftime("%Y%m%d")):
+    elif request_body == trip_query("trip_id_1"):
         return re.sub(r'"serviceDay":.*,',
                '"serviceDay": ' + str(int(time.mktime(time.strptime(datetime.datetime.now().strftime("%Y%m%d"), "%Y%m%d")))) + ",",
                '''
@@ -5795,7 +5828,7 @@ def mock():
 }
         ''')
 
-    elif request_body == '{ trip(id:\"trip_id_2\"){\n                        gtfsId\n                        stoptimesForDate(serviceDay:"%s"){\n                            serviceDay\n                            realtimeArrival\n                            stop{\n                                gtfsId\n                            }\n                            }\n                        }\n                    }' % (datetime.datetime.now().strftime("%Y%m%d")):
+    elif request_body == trip_query("trip_id_2"):
         return re.sub(r'"serviceDay":.*,',
                '"serviceDay": ' + str(
                    int(time.mktime(time.strptime(datetime.datetime.now().strftime("%Y%m%d"), "%Y%m%d")))) + ",",
@@ -5818,7 +5851,7 @@ def mock():
 }
         ''')
 
-    elif request_body == '{ trip(id:"trip_id_3"){\n                        gtfsId\n                        stoptimesForDate(serviceDay:"%s"){\n                            serviceDay\n                            realtimeArrival\n                            stop{\n                                gtfsId\n                            }\n                            }\n                        }\n                    }' % (datetime.datetime.now().strftime("%Y%m%d")):
+    elif request_body == trip_query("trip_id_3"):
         return re.sub(r'"serviceDay":.*,',
                '"serviceDay": ' + str(
                    int(time.mktime(time.strptime(datetime.datetime.now().strftime("%Y%m%d"), "%Y%m%d")))) + ",",
@@ -9423,7 +9456,7 @@ def mock():
     elif request_body == '{stop(id: "INVALID") {  name  code  vehicleType  stoptimesForServiceDate(date: "%s"){     pattern {         code         name         directionId         route {             gtfsId             longName             shortName         }     }     stoptimes {         trip{             gtfsId         }         stopHeadsign         serviceDay    	    realtimeArrival      }    }  }}' % (datetime.datetime.now().strftime("%Y%m%d")):
         return '{"data": { "stop": null } }'
 
-    elif request_body == '{trip(id: "INVALID") { stoptimesForDate(serviceDay: "%s") {      stop{          gtfsId          name          code }      serviceDay      realtimeArrival        }       }      }}' % (datetime.datetime.now().strftime("%Y%m%d")):
+    elif request_body == trip_query("INVALID"):
         return '{"data": { "trip": null } }'
 
     elif request_body == '''{fuzzyTrip(route:"1", date:"20161204", time:1000, direction:1){
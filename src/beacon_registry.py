@@ -0,0 +1,142 @@
+import csv
+import io
+import json
+import os
+import tempfile
+import threading
+
+STOP_BEACONS_URL = 'https://dev.hsl.fi/tmp/stop_beacons.csv'
+BUS_BEACONS_URL = 'http://dev.hsl.fi/tmp/bus_beacons.csv'
+
+
+class BeaconTable:
+    """
+    Rows of a beacon CSV file by (major, minor). The file is downloaded with conditional requests, so an unchanged file
+    isn't transferred again, and the latest copy is saved on disk to be used when the download fails.
+    """
+
+    def __init__(self, http_client, url, snapshot_path):
+        """
+        :param http_client: HTTPClient used for downloading the file
+        :param url: url of the CSV file
+        :param snapshot_path: path of the local copy of the file
+        """
+        self.http = http_client
+        self.url = url
+        self.snapshot_path = snapshot_path
+        self.beacons = {}
+        self.validators = {}  # ETag and Last-Modified of the loaded file
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def get(self, major, minor):
+        """
+        :param major: identifies iBeacon together with minor
+        :param minor: identifies iBeacon together with major
+        :return: CSV row of the beacon as a dict, None if the beacon is unknown
+        """
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.refresh()
+        try:
+            return self.beacons.get((int(major), int(minor)))
+        except (TypeError, ValueError):
+            return None
+
+    def refresh(self):
+        """
+        Downloads the CSV file if it has changed since it was loaded. If the download fails and nothing is loaded yet,
+        loads the local copy instead.
+        """
+        with self.lock:
+            headers = {}
+            if self.loaded and 'ETag' in self.validators:
+                headers['If-None-Match'] = self.validators['ETag']
+            if self.loaded and 'Last-Modified' in self.validators:
+                headers['If-Modified-Since'] = self.validators['Last-Modified']
+
+            try:
+                response = self.http.get(self.url, headers=headers)
+                if response.status_code == 304:
+                    return
+                response.raise_for_status()
+            except Exception as e:
+                print("Downloading %s failed: %s" % (self.url, e))
+                if not self.loaded:
+                    self.load_snapshot()
+                return
+
+            response.encoding = 'utf-8'
+            self.load(response.text, {k: response.headers[k] for k in ('ETag', 'Last-Modified') if k in response.headers})
+            self.save_snapshot(response.text)
+
+    def load(self, text, validators):
+        beacons = {}
+        for row in csv.DictReader(io.StringIO(text)):
+            try:
+                beacons[(int(row['Major']), int(row['Minor']))] = row
+            except (KeyError, TypeError, ValueError):
+                continue
+        self.beacons = beacons
+        self.validators = validators
+        self.loaded = True
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                text = f.read()
+            with open(self.snapshot_path + '.json', encoding='utf-8') as f:
+                validators = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Loading %s failed: %s" % (self.snapshot_path, e))
+            return
+        self.load(text, validators)
+
+    def save_snapshot(self, text):
+        try:
+            # Written aside and renamed, so a crash never leaves a partial snapshot behind
+            with open(self.snapshot_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+            with open(self.snapshot_path + '.json', 'w', encoding='utf-8') as f:
+                json.dump(self.validators, f)
+        except OSError as e:
+            print("Saving %s failed: %s" % (self.snapshot_path, e))
+
+
+class BeaconRegistry:
+    """
+    Stop and bus beacons published by HSL, kept in memory and refreshed periodically.
+    """
+
+    def __init__(self, http_client, snapshot_dir=None):
+        """
+        :param http_client: HTTPClient used for downloading the beacon files
+        :param snapshot_dir: directory of the local copies of the beacon files, defaults to the temp directory
+        """
+        snapshot_dir = snapshot_dir or tempfile.gettempdir()
+        self.stops = BeaconTable(http_client, STOP_BEACONS_URL, os.path.join(snapshot_dir, 'stop_beacons.csv'))
+        self.busses = BeaconTable(http_client, BUS_BEACONS_URL, os.path.join(snapshot_dir, 'bus_beacons.csv'))
+
+    def get_stop_beacon(self, major, minor):
+        """
+        :return: dict containing at least Major, Minor and Stop (stop code), None if the beacon is unknown
+        """
+        return self.stops.get(major, minor)
+
+    def get_bus_beacon(self, major, minor):
+        """
+        :return: dict containing at least Major, Minor and Vehicle, None if the beacon is unknown
+        """
+        return self.busses.get(major, minor)
+
+    def refresh(self):
+        """
+        Refreshes both beacon files. (Called periodically from stop.py, see thread_helper.py)
+        """
+        self.stops.refresh()
+        self.busses.refresh()
+
+    def stats(self):
+        return {'stop_beacons': len(self.stops.beacons), 'bus_beacons': len(self.busses.beacons)}
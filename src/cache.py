@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class Flight:
+    """
+    Load of a cache entry in progress, which other threads needing the same entry wait for.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    """
+    Thread safe in-memory cache. Entries expire ttl seconds after they have been stored and when the cache is full, the
+    least recently used entry is evicted.
+    """
+
+    def __init__(self, maxsize=1000, ttl=30):
+        """
+        :param maxsize: maximum number of entries
+        :param ttl: seconds an entry is valid after it has been stored
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, value), least recently used first
+        self.loading = {}  # key -> Flight
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def get(self, key, default=None):
+        """
+        :param key: key of the entry
+        :param default: returned if there is no valid entry for the key
+        :return: value of the entry or default
+        """
+        with self.lock:
+            return self.lookup(key, default)
+
+    def __contains__(self, key):
+        """
+        :return: True if there is a valid entry for the key. Doesn't count as a hit or a miss, nor as a use of the
+            entry.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def lookup(self, key, default):
+        # Caller must hold self.lock
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value to the cache, evicting the least recently used entries if the cache is full.
+
+        :param key: key of the entry
+        :param value: value of the entry
+        :param ttl: seconds the entry is valid, overrides the ttl of the cache
+        """
+        with self.lock:
+            self.store(key, value, self.ttl if ttl is None else ttl)
+
+    def store(self, key, value, ttl):
+        # Caller must hold self.lock
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, loader, ttl=None):
+        """
+        Gets the entry of key, or loads and stores it if there is no valid entry. Only one load of a key runs at a time:
+        threads missing the same key while it is being loaded wait for that load and get its result.
+
+        :param key: key of the entry
+        :param loader: function called without arguments, returns the value of the entry. None is returned to the
+            waiting threads but not stored.
+        :param ttl: seconds the loaded entry is valid, overrides the ttl of the cache
+        :return: value of the entry
+        """
+        missing = object()
+        with self.lock:
+            value = self.lookup(key, missing)
+            if value is not missing:
+                return value
+            flight = self.loading.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.loading[key] = Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                if flight.error is None and flight.value is not None:
+                    self.store(key, flight.value, self.ttl if ttl is None else ttl)
+                del self.loading[key]
+            flight.done.set()
+        return flight.value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        :return: dict containing size, maxsize, hits, misses, evictions, expirations and coalesced (misses which waited
+            for a load by another thread) of the cache
+        """
+        with self.lock:
+            return {'size': len(self.entries),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'coalesced': self.coalesced}
@@ -1,28 +1,81 @@
 import asyncio
+import contextlib
+import threading
 import time
 import psycopg2
+import psycopg2.extensions
 import psycopg2.pool
 import os
 
 import sys
 
+import migrate
+
+# Statements of the hot paths, prepared once per connection: name -> (parameter types, statement). See Database.execute
+STATEMENTS = {
+    'store_request': ("text, text, text, boolean",
+                      "INSERT INTO request (trip_id, stop_id, user_id, device_id, pushed, req_time, canceled) "
+                      "VALUES ($1, $2, 'user', $3, $4, now(), false) RETURNING id"),
+    'get_request_info': ("integer", "SELECT trip_id, stop_id FROM request WHERE id = $1"),
+    'cancel_request': ("integer", "UPDATE request SET canceled = true, cancel_time = now() "
+                                  "WHERE id = $1 AND canceled = false RETURNING trip_id, stop_id"),
+    'get_requests': ("text", "SELECT stop_id FROM request WHERE canceled = false AND trip_id = $1"),
+    'get_request_counts': ("double precision",
+                           "SELECT trip_id, stop_id, count(*), extract(epoch FROM max(req_time))::double precision FROM request "
+                           "WHERE canceled = false AND req_time > now() - $1 * interval '1 second' "
+                           "GROUP BY trip_id, stop_id"),
+    'store_report': ("text, text", "INSERT INTO report (trip_id, stop_id, user_id, report_time) "
+                                   "VALUES ($1, $2, 'user', now())"),
+    'get_unpushed_requests': ("", "SELECT trip_id,id,stop_id,device_id FROM request "
+                                  "WHERE canceled = false AND pushed = false"),
+    'set_pushed': ("integer[]", "UPDATE request SET pushed = true WHERE id = ANY($1)"),
+    'add_vehicles': ("text[], text[]", "INSERT INTO vehicle (vehicle_id, trip_id) SELECT * FROM unnest($1, $2) "
+                                       "ON CONFLICT DO NOTHING"),
+    'remove_vehicles': ("text[], text[]", "DELETE FROM vehicle USING unnest($1, $2) AS v (vehicle_id, trip_id) "
+                                          "WHERE vehicle.vehicle_id = v.vehicle_id AND vehicle.trip_id = v.trip_id"),
+}
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    Connection remembering which of STATEMENTS have been prepared in its session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
 
 class Database:
     def __init__(self):
+        self.minconn = int(os.getenv('DB_POOL_MIN', 1))
+        self.maxconn = int(os.getenv('DB_POOL_MAX', 20))
+        # ThreadedConnectionPool raises instead of waiting when all of its connections are in use
+        self.available = threading.BoundedSemaphore(self.maxconn)
+        self.stats_lock = threading.Lock()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
         loop = asyncio.get_event_loop()
         loop.run_until_complete(self.init_connection())
-    
+
     @asyncio.coroutine
     def init_connection(self):
         result = 1
         loop_end = time.time() + 10
         while time.time() < loop_end:
             try:
-                self.pool = psycopg2.pool.ThreadedConnectionPool(1, 20, host=os.getenv('DBHOST', 'localhost'),
+                self.pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn,
+                                                                 host=os.getenv('DBHOST', 'localhost'),
                                                                  port=os.getenv('DBPORT', '5432'),
                                                                  user=os.getenv('DBUSER', 'stop'),
                                                                  database=os.getenv('DBNAME', 'stop'),
-                                                                 password=os.getenv('DBPASS', 'stop'))
+                                                                 password=os.getenv('DBPASS', 'stop'),
+                                                                 connection_factory=PreparingConnection)
                 result = 0
                 break
             except:
@@ -30,108 +83,168 @@ class Database:
         if result:
             print ("Initializing a database connection failed")
             sys.exit()
-    
-    def get_connection(self):
-        return self.pool.getconn()
-    
-    def put_connection(self, conn):
-        self.pool.putconn(conn)
-    
+
+        with self.connection() as conn:
+            applied = migrate.migrate(conn)
+        if applied:
+            print ("Applied database migrations: %s" % ", ".join(str(version) for version in applied))
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the block, waiting for one if all of them are in use. Whatever the block
+        leaves uncommitted is rolled back, and the connection is always returned to the pool.
+        """
+        start = time.monotonic()
+        with self.stats_lock:
+            self.waiting += 1
+        self.available.acquire()
+        waited = time.monotonic() - start
+        with self.stats_lock:
+            self.waiting -= 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            yield conn
+        finally:
+            if conn is not None:
+                close = False
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    # The connection is broken, don't hand it out again
+                    close = True
+                self.pool.putconn(conn, close=close)
+            with self.stats_lock:
+                self.in_use -= 1
+            self.available.release()
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """
+        Cursor for reading, nothing done with it is committed. The cursor is closed when the block exits.
+        """
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Cursor for writing, committed when the block exits without an exception. The cursor is closed when the block
+        exits.
+        """
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+                conn.commit()
+            finally:
+                cur.close()
+
+    def execute(self, cur, name, values=()):
+        """
+        Executes a statement of STATEMENTS by name, preparing it first if the connection hasn't prepared it yet.
+        Prepared statements last as long as the connection, also over rolled back transactions.
+
+        :param cur: cursor
+        :param name: name of the statement
+        :param values: values of the parameters of the statement
+        """
+        conn = cur.connection
+        if name not in conn.prepared:
+            types, statement = STATEMENTS[name]
+            cur.execute("PREPARE %s %sAS %s" % (name, "(%s) " % types if types else "", statement))
+            conn.prepared.add(name)
+        if values:
+            cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(values))), values)
+        else:
+            cur.execute("EXECUTE %s" % name)
+
+    def stats(self):
+        """
+        :return: dict containing pool size, connections in use, threads waiting for a connection and the average and
+            maximum time in milliseconds waited for a connection
+        """
+        with self.stats_lock:
+            return {'size': self.maxconn,
+                    'in_use': self.in_use,
+                    'max_in_use': self.max_in_use,
+                    'waiting': self.waiting,
+                    'acquired': self.acquired,
+                    'avg_wait_ms': 1000 * self.total_wait / self.acquired if self.acquired else 0,
+                    'max_wait_ms': 1000 * self.max_wait}
+
     def store_request(self, trip_id, stop_id, device_id, push_notification):
-        conn = self.get_connection()
-        cur = conn.cursor()
         if device_id == '0':
             values = (trip_id, stop_id, device_id, True)
         else:
             values = (trip_id, stop_id, device_id, not push_notification)
-        sql = "INSERT INTO request (trip_id, stop_id, user_id, device_id, pushed, req_time, canceled) VALUES (%s, %s, 'user', %s, %s, now(), false) RETURNING id"
-        cur.execute(sql, values)
-        request_id = cur.fetchone()[0]
-        conn.commit()
-        self.put_connection(conn)
-        return request_id
-    
+        with self.transaction() as cur:
+            self.execute(cur, 'store_request', values)
+            return cur.fetchone()[0]
+
     def get_request_info(self, request_id):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        values = (request_id,)
-        sql = "SELECT trip_id, stop_id FROM request WHERE id = %s"
-        cur.execute(sql, values)
-        result = cur.fetchone()
-        self.put_connection(conn)
-        return result
+        with self.cursor() as cur:
+            self.execute(cur, 'get_request_info', (request_id,))
+            return cur.fetchone()
 
     def cancel_request(self, request_id):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        values = (request_id,)
-        sql = "UPDATE request SET canceled = true, cancel_time = now() WHERE id = %s RETURNING trip_id"
-        cur.execute(sql, values)
-        trip_id = cur.fetchone()[0]
-        conn.commit()
-        self.put_connection(conn)
-        return trip_id
-        
+        with self.transaction() as cur:
+            self.execute(cur, 'cancel_request', (request_id,))
+            return cur.fetchone()
+
     def get_requests(self, trip_id):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        values = (trip_id,)
-        sql = "SELECT stop_id FROM request WHERE canceled = false AND trip_id = %s"
-        cur.execute(sql, values)
-        result = cur.fetchall()
-        self.put_connection(conn)
-        return result
+        with self.cursor() as cur:
+            self.execute(cur, 'get_requests', (trip_id,))
+            return cur.fetchall()
+
+    def get_request_counts(self, max_age):
+        """
+        :param max_age: seconds, older requests are left out
+        :return: list of (trip_id, stop_id, number of uncanceled requests, time of the latest request as a timestamp)
+        """
+        with self.cursor() as cur:
+            self.execute(cur, 'get_request_counts', (max_age,))
+            return cur.fetchall()
 
     def store_report(self, trip_id, stop_id):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        values = (trip_id, stop_id)
-        sql = "INSERT INTO report (trip_id, stop_id, user_id, report_time) VALUES (%s, %s, 'user', now())"
-        cur.execute(sql, values)
-        conn.commit()
-        self.put_connection(conn)
-    
+        with self.transaction() as cur:
+            self.execute(cur, 'store_report', (trip_id, stop_id))
+
     def get_unpushed_requests(self):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        sql = "SELECT trip_id,id,stop_id,device_id FROM request WHERE canceled = false AND pushed = false"
-        cur.execute(sql)
-        result = cur.fetchall()
-        self.put_connection(conn)
-        return result
-    
+        with self.cursor() as cur:
+            self.execute(cur, 'get_unpushed_requests')
+            return cur.fetchall()
+
     def set_pushed(self, ids):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        values = (tuple(ids),)
-        sql = "UPDATE request SET pushed = true WHERE id IN %s"
-        cur.execute(sql, values)
-        conn.commit()
-        self.put_connection(conn)
-
-    def add_vehicle(self, vehicle_id, trip_id):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        values = (vehicle_id, trip_id)
-        sql = "INSERT INTO vehicle (vehicle_id, trip_id) VALUES (%s, %s)"
-        cur.execute(sql, values)
-        conn.commit()
-        self.put_connection(conn)
-
-    def remove_vehicle(self, vehicle_id, trip_id):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        values = (vehicle_id, trip_id)
-        sql = "DELETE FROM vehicle WHERE vehicle_id = %s AND trip_id = %s"
-        cur.execute(sql, values)
-        conn.commit()
-        self.put_connection(conn)
+        with self.transaction() as cur:
+            self.execute(cur, 'set_pushed', (list(ids),))
+
+    def write_vehicles(self, added, removed):
+        """
+        Adds and removes vehicles in one transaction.
+
+        :param added: list of (vehicle_id, trip_id) to add
+        :param removed: list of (vehicle_id, trip_id) to remove
+        """
+        with self.transaction() as cur:
+            if added:
+                self.execute(cur, 'add_vehicles', ([v[0] for v in added], [v[1] for v in added]))
+            if removed:
+                self.execute(cur, 'remove_vehicles', ([v[0] for v in removed], [v[1] for v in removed]))
 
     def get_vehicles(self):
-        conn = self.get_connection()
-        cur = conn.cursor()
-        sql = "SELECT trip_id FROM vehicle"
-        cur.execute(sql)
-        result = cur.fetchall()
-        self.put_connection(conn)
-        return result
+        sql = "SELECT vehicle_id, trip_id FROM vehicle"
+        with self.cursor() as cur:
+            cur.execute(sql)
+            return cur.fetchall()
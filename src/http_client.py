@@ -0,0 +1,71 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+class HTTPClient:
+    """
+    Keep-alive HTTP client, which reuses pooled connections between requests and retries failed requests with
+    exponential backoff.
+    """
+
+    def __init__(self, pool_size=10, timeout=10, retries=3, backoff_factor=0.3):
+        """
+        :param pool_size: number of connections kept open per host
+        :param timeout: seconds to wait for the server to connect and to send data
+        :param retries: how many times a failed request is retried
+        :param backoff_factor: retries sleep backoff_factor * 2^(retry number - 1) seconds before retrying
+        """
+        self.timeout = timeout
+        # GraphQL queries are sent with POST, but they don't change anything so they are safe to retry
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[500, 502, 503, 504],
+                      method_whitelist=frozenset(['GET', 'POST']))
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request using a pooled connection. Takes the same arguments as requests.request.
+
+        :return: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.errors += 1
+            raise
+
+    def stats(self):
+        """
+        Counts the requests sent and the connections opened by the pools of all hosts. Every request which didn't open
+        a new connection reused a pooled one.
+
+        :return: dict containing requests, new_connections, reused_connections and errors
+        """
+        num_requests = 0
+        num_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:  # Evicted after listing the keys
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+
+        return {'requests': num_requests,
+                'new_connections': num_connections,
+                'reused_connections': max(num_requests - num_connections, 0),
+                'errors': self.errors}
@@ -0,0 +1,57 @@
+import os
+import re
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# Key of the advisory lock held while migrating, so that only one server applies the migrations at a time
+MIGRATION_LOCK = 2017001
+
+
+def find_migrations(directory=MIGRATIONS_DIR):
+    """
+    :param directory: directory containing the migrations, named <version>_<description>.sql
+    :return: list of (version, path) sorted by version
+    """
+    migrations = []
+    for name in os.listdir(directory):
+        match = re.match(r'^(\d+)_\w+\.sql$', name)
+        if match:
+            migrations.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(migrations)
+
+
+def migrate(conn, directory=MIGRATIONS_DIR):
+    """
+    Applies the migrations not yet recorded in table schema_migrations, each one in its own transaction.
+
+    :param conn: database connection
+    :param directory: directory containing the migrations
+    :return: list of the versions applied
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK,))
+    try:
+        cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version integer PRIMARY KEY, "
+                    "applied_time timestamp with time zone)")
+        conn.commit()
+        cur.execute("SELECT version FROM schema_migrations")
+        applied_versions = set(row[0] for row in cur.fetchall())
+
+        applied = []
+        for version, path in find_migrations(directory):
+            if version in applied_versions:
+                continue
+            with open(path) as f:
+                sql = f.read()
+            try:
+                cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (version, applied_time) VALUES (%s, now())", (version,))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                print("Applying migration %s failed" % os.path.basename(path))
+                raise
+            applied.append(version)
+        return applied
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+        conn.commit()
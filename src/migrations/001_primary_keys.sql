@@ -0,0 +1,3 @@
+ALTER TABLE request ADD PRIMARY KEY (id);
+ALTER TABLE report ADD PRIMARY KEY (id);
+ALTER TABLE vehicle ADD PRIMARY KEY (id);
@@ -0,0 +1,5 @@
+-- Requests still waiting for a push notification, see get_unpushed_requests
+CREATE INDEX request_unpushed_idx ON request (id) WHERE canceled = false AND pushed = false;
+
+-- Requests of a trip, see get_requests
+CREATE INDEX request_trip_id_idx ON request (trip_id);
@@ -0,0 +1,4 @@
+-- A vehicle may have been stored more than once for the same trip, keep the first row
+DELETE FROM vehicle a USING vehicle b WHERE a.vehicle_id = b.vehicle_id AND a.trip_id = b.trip_id AND a.id > b.id;
+
+CREATE UNIQUE INDEX vehicle_vehicle_id_trip_id_idx ON vehicle (vehicle_id, trip_id);
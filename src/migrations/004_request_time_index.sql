@@ -0,0 +1,2 @@
+-- Uncanceled requests of the latest service days, see get_request_counts
+CREATE INDEX request_req_time_idx ON request (req_time) WHERE canceled = false;
@@ -1,10 +1,13 @@
 import json
+import queue
+import threading
+import time
 import paho.mqtt.client as mqtt
 
 
 class MQTT:
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, active_vehicles):
+        self.active_vehicles = active_vehicles
         client = mqtt.Client()
 
         client.on_connect = self.on_connect
@@ -20,6 +23,125 @@ class MQTT:
     def on_message(self, client, userdata, msg):
         message = json.loads(msg.payload.decode('UTF-8'))
         if message.get('status') == 'start':
-            self.db.add_vehicle(message.get('veh_id'), message.get('gtfsId'))
+            self.active_vehicles.add(message.get('veh_id'), message.get('gtfsId'))
         elif message.get('status') == 'stop':
-            self.db.remove_vehicle(message.get('veh_id'), message.get('gtfsId'))
+            self.active_vehicles.remove(message.get('veh_id'), message.get('gtfsId'))
+
+
+class MQTTPublisher:
+    """
+    Publishes messages through one long-lived connection to the MQTT server. Messages are queued and sent by a
+    background thread, so publishing never waits for the server. The connection is reopened automatically if it drops,
+    if a publish fails or if the server doesn't acknowledge the connection within reconnect_timeout seconds. The
+    connection is owned by a network thread of its own, which is the only thread reconnecting the client. The
+    connection is opened and the queued messages are sent once start has been called.
+    """
+
+    def __init__(self, host, port=1883, qos=0, max_queue=10000, reconnect_timeout=10):
+        """
+        :param host: MQTT server
+        :param port: port of the MQTT server
+        :param qos: quality of service level of the published messages
+        :param max_queue: maximum number of queued messages, messages published when the queue is full are dropped
+        :param reconnect_timeout: seconds to wait for the connection before reconnecting
+        """
+        self.qos = qos
+        self.reconnect_timeout = reconnect_timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.host = host
+        self.port = port
+
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+
+        self.network_thread = threading.Thread(target=self.loop, name="mqtt-network", daemon=True)
+        self.thread = threading.Thread(target=self.run, name="mqtt-publisher", daemon=True)
+
+    def start(self):
+        """
+        Connects to the MQTT server and starts sending the queued messages from a background thread.
+        """
+        self.client.connect_async(self.host, self.port, 60)
+        self.network_thread.start()
+        self.thread.start()
+
+    def loop(self):
+        while True:
+            # Reconnects by itself when the connection drops, and returns when reconnect disconnects the client
+            self.client.loop_forever(retry_first_connection=True)
+            while True:
+                try:
+                    self.client.reconnect()
+                    break
+                except Exception as e:
+                    print("Reconnecting to the MQTT server failed: %s" % e)
+                    time.sleep(1)
+
+    def on_connect(self, client, userdata, flags, rc):
+        print("Publisher connected to the MQTT server with result code " + str(rc))
+        if rc == 0:
+            self.connected.set()
+
+    def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+
+    def publish(self, topic, payload):
+        """
+        Queues a message to be published.
+
+        :param topic: topic of the message
+        :param payload: payload of the message as string
+        """
+        try:
+            self.queue.put_nowait((time.monotonic(), topic, payload))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            queued, topic, payload = self.queue.get()
+            # Retried until the message is handed over to a connected client
+            while True:
+                if self.connected.wait(self.reconnect_timeout) and \
+                        self.client.publish(topic, payload, qos=self.qos)[0] == mqtt.MQTT_ERR_SUCCESS:
+                    break
+                self.connected.clear()
+                self.reconnect()
+
+            latency = time.monotonic() - queued
+            with self.lock:
+                self.published += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def reconnect(self):
+        # paho reconnects by itself only when it notices the disconnect, which it doesn't if the connection is left
+        # half-open. The socket belongs to the network thread, so the client is only disconnected here and the network
+        # thread opens the new connection.
+        with self.lock:
+            self.reconnects += 1
+        self.client.disconnect()
+
+    def stats(self):
+        """
+        :return: dict containing queue depth, connection state, published and dropped message counts, number of
+            reconnects and the average and maximum time in milliseconds the messages have been queued
+        """
+        with self.lock:
+            return {'queue_depth': self.queue.qsize(),
+                    'connected': self.connected.is_set(),
+                    'published': self.published,
+                    'dropped': self.dropped,
+                    'reconnects': self.reconnects,
+                    'avg_latency_ms': 1000 * self.total_latency / self.published if self.published else 0,
+                    'max_latency_ms': 1000 * self.max_latency}
@@ -1,22 +1,221 @@
 from pyfcm import FCMNotification
+from pyfcm.errors import AuthenticationError, InvalidDataError
+import collections
 import os
+import queue
+import threading
+import time
+
+# Maximum number of registration ids in one FCM request
+FCM_MAX_RECIPIENTS = 1000
+
+# Outcomes of the notifications of the devices, see PushNotificationService.queue_push_notifications
+PUSH_SENT = 'sent'
+PUSH_FAILED = 'failed'  # Sending failed even after retrying, may succeed later
+PUSH_INVALID = 'invalid'  # FCM rejected the registration id, will never succeed
+
+# Errors of a device which are worth retrying, the other errors are caused by the registration id or the message. See:
+# https://firebase.google.com/docs/cloud-messaging/http-server-ref#error-codes
+TRANSIENT_ERRORS = ('Unavailable', 'InternalServerError', 'DeviceMessageRateExceeded')
+
+PUSH_MESSAGE = {
+    "title": "Kulkuneuvo saapuu!",
+    "message": "Tilaamasi kulkuneuvo on pysäkilläsi hetken kuluttua"
+}
 
 
 class PushNotificationService():
+    """
+    Sends push notifications through FCM. Notifications queued with queue_push_notifications or
+    queue_error_push_notifications are sent by worker threads, at most FCM_MAX_RECIPIENTS devices per request.
+    Failed requests, and the devices whose notifications failed for a transient reason, are retried with exponential
+    backoff.
+    """
+
+    def __init__(self, workers=2, max_queue=1000, retries=3, backoff=1.0):
+        """
+        :param workers: number of threads sending the queued notifications
+        :param max_queue: maximum number of queued notifications, notifications queued when the queue is full are
+            dropped
+        :param retries: number of times a failed request is retried
+        :param backoff: seconds waited before the first retry, doubled for every further retry
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.failures = 0
+        self.retried = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.retried_devices = 0
+        self.outcomes = {PUSH_SENT: 0, PUSH_FAILED: 0, PUSH_INVALID: 0}
+
+        self.threads = [threading.Thread(target=self.run, name="push-%d" % i, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def client(self):
+        """
+        :return: new FCM client. pyfcm keeps the responses of every request made with a client and returns all of them
+            for each request, so a client is used for one request only.
+        """
+        return FCMNotification(api_key=os.getenv('FCM_API_KEY'))
 
     def send_push_notifications(self, registration_ids):
-        push_service = FCMNotification(api_key=os.getenv('FCM_API_KEY'))
-        data_message = {
-            "title": "Kulkuneuvo saapuu!",
-            "message": "Tilaamasi kulkuneuvo on pysäkilläsi hetken kuluttua"
-        }
-        return push_service.notify_multiple_devices(registration_ids=registration_ids,
-                                                      data_message=data_message)
+        """
+        Sends the arrival notification to the devices and waits for the responses.
+
+        :param registration_ids: list of registration ids of the devices
+        :return: list of FCM responses, one per FCM_MAX_RECIPIENTS devices
+        """
+        return self.send(registration_ids, PUSH_MESSAGE)
 
     def send_error_push_notifications(self, registration_ids, error_message):
-        push_service = FCMNotification(api_key=os.getenv('FCM_API_KEY'))
+        """
+        Same as send_push_notifications for an error message.
+        """
+        return self.send(registration_ids, {"title": "Error", "message": error_message})
+
+    def queue_push_notifications(self, registration_ids, callback=None):
+        """
+        Queues the arrival notification to be sent to the devices.
+
+        :param registration_ids: list of registration ids of the devices
+        :param callback: called when the notifications have been sent with dict where result[registration_id] =
+            PUSH_SENT, PUSH_FAILED or PUSH_INVALID
+        """
+        self.put(registration_ids, PUSH_MESSAGE, callback)
+
+    def queue_error_push_notifications(self, registration_ids, error_message, callback=None):
+        """
+        Same as queue_push_notifications for an error message.
+        """
+        self.put(registration_ids, {"title": "Error", "message": error_message}, callback)
+
+    def put(self, registration_ids, data_message, callback):
+        try:
+            self.queue.put_nowait((registration_ids, data_message, callback))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            if callback:
+                callback({registration_id: PUSH_FAILED for registration_id in registration_ids})
+
+    def run(self):
+        while True:
+            registration_ids, data_message, callback = self.queue.get()
+            outcomes = self.deliver(registration_ids, data_message)
+            if callback:
+                try:
+                    callback(outcomes)
+                except Exception as e:
+                    print("Handling sent push notifications failed:", e)
+
+    def deliver(self, registration_ids, data_message):
+        """
+        Sends the message to the devices, retrying the devices whose notifications failed for a transient reason.
+
+        :return: dict where result[registration_id] = PUSH_SENT, PUSH_FAILED or PUSH_INVALID
+        """
+        outcomes = {}
+        pending = list(collections.OrderedDict.fromkeys(registration_ids))
+        attempt = 0
+        while True:
+            try:
+                results = self.device_results(pending, self.send(pending, data_message))
+            except Exception as e:
+                # The request has already been retried by send_batch
+                print("Sending push notifications failed:", e)
+                outcomes.update((registration_id, PUSH_FAILED) for registration_id in pending)
+                break
+
+            pending = []
+            for registration_id, result in results.items():
+                if 'message_id' in result:
+                    outcomes[registration_id] = PUSH_SENT
+                elif result.get('error') in TRANSIENT_ERRORS:
+                    outcomes[registration_id] = PUSH_FAILED
+                    pending.append(registration_id)
+                else:
+                    outcomes[registration_id] = PUSH_INVALID
+
+            if not pending or attempt >= self.retries:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+            with self.lock:
+                self.retried_devices += len(pending)
+
+        with self.lock:
+            for outcome in outcomes.values():
+                self.outcomes[outcome] += 1
+        return outcomes
+
+    def device_results(self, registration_ids, responses):
+        """
+        :param registration_ids: list of registration ids the notifications were sent to
+        :param responses: FCM responses of the requests, in the order the registration ids were sent
+        :return: dict where result[registration_id] = result of the device in the FCM response, containing either
+            message_id or error
+        """
+        results = [result for response in responses for result in response.get('results', [])]
+        if len(results) != len(registration_ids):
+            raise ValueError("FCM returned %d results for %d devices" % (len(results), len(registration_ids)))
+        return dict(zip(registration_ids, results))
+
+    def send(self, registration_ids, data_message):
+        responses = []
+        for i in range(0, len(registration_ids), FCM_MAX_RECIPIENTS):
+            responses.extend(self.send_batch(registration_ids[i:i + FCM_MAX_RECIPIENTS], data_message))
+        return responses
+
+    def send_batch(self, registration_ids, data_message):
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                responses = self.client().notify_multiple_devices(registration_ids=registration_ids,
+                                                                  data_message=data_message)
+            except (AuthenticationError, InvalidDataError):
+                with self.lock:
+                    self.failures += 1
+                raise
+            except Exception:
+                with self.lock:
+                    self.failures += 1
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+                with self.lock:
+                    self.retried += 1
+                continue
+
+            latency = time.monotonic() - start
+            with self.lock:
+                self.batches += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            return responses
 
-        data_message = {
-            "title": "Error",
-            "message": error_message
-        }
\ No newline at end of file
+    def stats(self):
+        """
+        :return: dict containing queue depth, the number of sent batches, failed and retried requests, dropped
+            notifications, retried devices and the outcomes of the devices, and the average and maximum time in
+            milliseconds a batch took to send
+        """
+        with self.lock:
+            return {'queue_depth': self.queue.qsize(),
+                    'retried_devices': self.retried_devices,
+                    'devices_sent': self.outcomes[PUSH_SENT],
+                    'devices_failed': self.outcomes[PUSH_FAILED],
+                    'devices_invalid': self.outcomes[PUSH_INVALID],
+                    'batches': self.batches,
+                    'failures': self.failures,
+                    'retried': self.retried,
+                    'dropped': self.dropped,
+                    'avg_latency_ms': 1000 * self.total_latency / self.batches if self.batches else 0,
+                    'max_latency_ms': 1000 * self.max_latency}
@@ -0,0 +1,229 @@
+import heapq
+import math
+import threading
+import time
+
+# Seconds between the checks of a trip by the seconds until it arrives at the stop of its next request, the first
+# entry whose arrival limit is reached is used
+CHECK_INTERVALS = ((1200, 300),
+                   (600, 60),
+                   (300, 15),
+                   (0, 5))
+
+
+class TokenBucket:
+    """
+    Allows rate actions per second on average and bursts of up to capacity actions. Not thread safe.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def available(self):
+        """
+        :return: number of actions allowed right now
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return int(self.tokens)
+
+    def take(self, count):
+        self.tokens -= count
+
+
+class PushScheduler:
+    """
+    Requests waiting for a push notification, grouped by trip, with the time each trip needs to be checked next. The
+    interval between the checks of a trip depends on how far its bus is from the stop of its next request (see
+    CHECK_INTERVALS), so trips far away are checked rarely and trips close to the stop every few seconds. The upstream
+    queries of the checks are limited to max_rate per second, the trips over the limit are checked on a later call of
+    due, the ones due first first. Requests whose push notification failed are added back after a delay growing with
+    every failure, until they have failed max_retries times.
+    """
+
+    def __init__(self, lead_time=120, intervals=CHECK_INTERVALS, min_interval=5, max_rate=10, retry_delay=5,
+                 max_retries=5):
+        """
+        :param lead_time: seconds before the arrival the push notification is sent
+        :param intervals: tuple of (seconds until arrival, seconds between checks), see CHECK_INTERVALS
+        :param min_interval: minimum seconds between the checks of a trip
+        :param max_rate: maximum number of upstream queries of the trip checks per second, 0 means unlimited
+        :param retry_delay: seconds before a failed request is added back, doubled for every further failure
+        :param max_retries: number of times a failed request is added back
+        """
+        self.lead_time = lead_time
+        self.intervals = intervals
+        self.min_interval = min_interval
+        self.budget = TokenBucket(max_rate) if max_rate else None
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.throttled = 0
+        self.given_up = 0
+        self.lock = threading.Lock()
+        self.requests = {}  # trip_id -> {request_id: (stop_id, device_id)}
+        self.next_check = {}  # trip_id -> time of the next check
+        self.queue = []  # heap of (time of check, trip_id), entries not matching next_check are left over from reschedules
+        self.failures = {}  # request_id -> number of failed push notifications
+        self.retrying = {}  # request_id -> (time added back, trip_id, stop_id, device_id) of the failed requests
+        self.retry_queue = []  # heap of (time added back, request_id), entries not matching retrying are left over
+        self.checks = 0
+
+    def load(self, stoprequests):
+        """
+        Replaces the requests with the given ones, all of their trips are checked right away.
+
+        :param stoprequests: dict where stoprequests[trip_id] = [ (request_id_1, stop_id_1, device_id_1), ... ]
+        """
+        with self.lock:
+            self.requests = {}
+            self.next_check = {}
+            self.queue = []
+            self.failures = {}
+            self.retrying = {}
+            self.retry_queue = []
+        for trip_id, requests in stoprequests.items():
+            for request_id, stop_id, device_id in requests:
+                self.add(trip_id, request_id, stop_id, device_id)
+
+    def add(self, trip_id, request_id, stop_id, device_id):
+        """
+        Adds a request, its trip is checked right away.
+        """
+        with self.lock:
+            self.requests.setdefault(trip_id, {})[request_id] = (stop_id, device_id)
+            self.schedule(trip_id, time.monotonic())
+
+    def remove(self, trip_id, request_id):
+        with self.lock:
+            self.retrying.pop(request_id, None)
+            requests = self.requests.get(trip_id)
+            if requests is None:
+                return
+            requests.pop(request_id, None)
+            if not requests:
+                del self.requests[trip_id]
+                self.next_check.pop(trip_id, None)
+
+    def retry(self, trip_id, request_id, stop_id, device_id):
+        """
+        Adds back a request whose push notification failed, after retry_delay * 2^(number of failures - 1) seconds.
+
+        :return: False if the request has already failed max_retries times, in which case it's given up
+        """
+        with self.lock:
+            failures = self.failures.get(request_id, 0) + 1
+            if failures > self.max_retries:
+                self.failures.pop(request_id, None)
+                self.given_up += 1
+                return False
+            self.failures[request_id] = failures
+            retry_time = time.monotonic() + self.retry_delay * 2 ** (failures - 1)
+            self.retrying[request_id] = (retry_time, trip_id, stop_id, device_id)
+            heapq.heappush(self.retry_queue, (retry_time, request_id))
+            return True
+
+    def done(self, request_id):
+        """
+        Forgets the failures of a request whose push notification has been sent or which has been canceled.
+        """
+        with self.lock:
+            self.failures.pop(request_id, None)
+
+    def due(self, cached=None, batch_size=1):
+        """
+        Takes the trips whose check is due, as many as the budget allows. The budget is spent per upstream query: the
+        trips which aren't cached are fetched batch_size trips per query and the cached ones cost nothing. A taken trip
+        isn't checked again until checked is called for it.
+
+        :param cached: function telling if the stoptimes of a trip are cached, None if no trip is
+        :param batch_size: maximum number of trips fetched with one query
+        :return: dict where result[trip_id] = [ (request_id_1, stop_id_1, device_id_1), ... ]
+        """
+        now = time.monotonic()
+        result = {}
+        uncached = 0
+        with self.lock:
+            while self.retry_queue and self.retry_queue[0][0] <= now:
+                retry_time, request_id = heapq.heappop(self.retry_queue)
+                retrying = self.retrying.get(request_id)
+                if retrying is None or retrying[0] != retry_time:
+                    continue
+                del self.retrying[request_id]
+                retry_time, trip_id, stop_id, device_id = retrying
+                self.requests.setdefault(trip_id, {})[request_id] = (stop_id, device_id)
+                self.schedule(trip_id, now)
+
+            allowed = self.budget.available() * batch_size if self.budget else None
+            while self.queue and self.queue[0][0] <= now:
+                check_time, trip_id = self.queue[0]
+                if self.next_check.get(trip_id) != check_time:
+                    heapq.heappop(self.queue)
+                    continue
+                is_cached = cached is not None and cached(trip_id)
+                if not is_cached and allowed is not None and uncached >= allowed:
+                    self.throttled += 1
+                    break
+                heapq.heappop(self.queue)
+                del self.next_check[trip_id]
+                if not is_cached:
+                    uncached += 1
+                result[trip_id] = [(request_id, stop_id, device_id)
+                                   for request_id, (stop_id, device_id) in self.requests[trip_id].items()]
+            self.checks += len(result)
+            if self.budget:
+                self.budget.take(math.ceil(uncached / batch_size))
+        return result
+
+    def checked(self, trip_id, arrives_in):
+        """
+        Schedules the next check of a trip taken with due.
+
+        :param trip_id: trip id
+        :param arrives_in: seconds until the trip arrives at the stop of its next remaining request, None if it isn't
+            known (e.g. the query failed), in which case the trip is checked again after min_interval
+        """
+        with self.lock:
+            if trip_id not in self.requests or trip_id in self.next_check:
+                return
+            self.schedule(trip_id, time.monotonic() + self.interval(arrives_in))
+
+    def interval(self, arrives_in):
+        """
+        :return: seconds until the next check of a trip arriving in arrives_in seconds, never past the time its
+            notifications are due
+        """
+        if arrives_in is None:
+            return self.min_interval
+        for limit, interval in self.intervals:
+            if arrives_in >= limit:
+                return max(min(interval, arrives_in - self.lead_time), self.min_interval)
+        return self.min_interval
+
+    def schedule(self, trip_id, check_time):
+        # Caller must hold self.lock. An earlier check is never postponed.
+        if trip_id in self.next_check and self.next_check[trip_id] <= check_time:
+            return
+        self.next_check[trip_id] = check_time
+        heapq.heappush(self.queue, (check_time, trip_id))
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(requests) for requests in self.requests.values()) + len(self.retrying)
+
+    def stats(self):
+        """
+        :return: dict containing the number of trips and requests waiting, the number of failed requests waiting to be
+            added back, the number of trip checks, the number of times checks were postponed because of the budget and
+            the number of requests given up
+        """
+        with self.lock:
+            return {'trips': len(self.requests),
+                    'requests': sum(len(requests) for requests in self.requests.values()),
+                    'retrying': len(self.retrying),
+                    'checks': self.checks,
+                    'throttled': self.throttled,
+                    'given_up': self.given_up}
@@ -0,0 +1,187 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """
+    Periodic job of a Scheduler.
+    """
+
+    def __init__(self, name, interval, func, iterations, next_run):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.iterations = iterations  # Runs left, 0 means infinite
+        self.next_run = next_run
+        self.running = False
+        self.stopped = False
+        self.restarted = False  # Started again while running, see Scheduler.stop
+        self.runs = 0
+        self.failures = 0
+        self.overruns = 0
+        self.last_duration = 0
+
+    def stats(self):
+        return {'interval': self.interval,
+                'running': self.running,
+                'runs': self.runs,
+                'failures': self.failures,
+                'overruns': self.overruns,
+                'last_duration_ms': 1000 * self.last_duration}
+
+
+class Scheduler:
+    """
+    Runs periodic jobs. A single thread waits for the jobs to come due and hands their runs to a pool of worker
+    threads, so a slow job doesn't delay the others. Jobs are identified by name and a job with the same name can't be
+    started twice. A run of a job is never started while its previous run is still going on: if a run takes longer
+    than the interval, the next one starts as soon as it has finished. The threads are started by the first job.
+    """
+
+    def __init__(self, max_workers=10):
+        """
+        :param max_workers: maximum number of jobs running at the same time
+        """
+        self.condition = threading.Condition()
+        self.jobs = {}  # name -> Job
+        self.queue = []  # heap of (next run, sequence number, Job), stopped jobs are skipped when they come up
+        self.sequence = itertools.count()
+        self.shutting_down = False
+        self.local = threading.local()  # local.job is the job run by the current worker thread
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.thread = None
+
+    def start(self, name, interval, func, iterations=0, delay=0):
+        """
+        Starts running func every interval seconds unless a job called name is already running.
+
+        :param name: name of the job
+        :param interval: interval the job is run in seconds
+        :param func: function run by the job
+        :param iterations: number of runs, 0 means infinite
+        :param delay: seconds until the first run
+        :return: True if the job was started, False if it was already running
+        """
+        with self.condition:
+            job = self.jobs.get(name)
+            if job is not None:
+                if job.running:
+                    job.restarted = True
+                return False
+
+            job = Job(name, interval, func, iterations, time.monotonic() + delay)
+            self.jobs[name] = job
+            self.push(job)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+                self.thread.start()
+            return True
+
+    def stop(self, name):
+        """
+        Stops the job called name. A job that stops itself when it runs out of work keeps running if it was started
+        again during the same run, so that work added meanwhile isn't left waiting.
+
+        :param name: name of the job
+        """
+        with self.condition:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            if job.running and job.restarted:
+                job.restarted = False
+                return
+            self.remove(job)
+
+    def is_running(self, name):
+        with self.condition:
+            return name in self.jobs
+
+    def shutdown(self, wait=True):
+        """
+        Stops all jobs. A run that is going on is let finish.
+
+        :param wait: wait for the scheduler thread and the runs going on to finish, unless called from a job
+        """
+        with self.condition:
+            self.shutting_down = True
+            for job in list(self.jobs.values()):
+                self.remove(job)
+            self.condition.notify()
+            thread = self.thread
+        wait = wait and threading.current_thread() is not thread and getattr(self.local, 'job', None) is None
+        if wait and thread is not None:
+            thread.join()
+        self.executor.shutdown(wait=wait)
+
+    def push(self, job):
+        # Caller must hold self.condition
+        heapq.heappush(self.queue, (job.next_run, next(self.sequence), job))
+        self.condition.notify()
+
+    def remove(self, job):
+        # Caller must hold self.condition
+        job.stopped = True
+        del self.jobs[job.name]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.shutting_down:
+                        return
+                    if self.queue and self.queue[0][2].stopped:
+                        heapq.heappop(self.queue)
+                        continue
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                job = heapq.heappop(self.queue)[2]
+                job.running = True
+
+            try:
+                self.executor.submit(self.execute, job)
+            except RuntimeError:  # Shut down meanwhile
+                return
+
+    def execute(self, job):
+        # Runs on a worker thread, the job is pushed back to the queue once the run has finished
+        self.local.job = job
+        start = time.monotonic()
+        try:
+            job.func()
+        except Exception as e:
+            print("Job %s failed: %s" % (job.name, e))
+            job.failures += 1
+        finally:
+            self.local.job = None
+        duration = time.monotonic() - start
+
+        with self.condition:
+            job.running = False
+            job.restarted = False
+            job.runs += 1
+            job.last_duration = duration
+            if duration > job.interval:
+                job.overruns += 1
+            if job.iterations == 1 and not job.stopped:
+                self.remove(job)
+            if job.stopped:
+                return
+            if job.iterations > 1:
+                job.iterations -= 1
+            # Keeps the pace of the job unless the run took longer than the interval
+            job.next_run = max(job.next_run + job.interval, time.monotonic())
+            self.push(job)
+
+    def stats(self):
+        """
+        :return: dict containing the statistics of every job by name
+        """
+        with self.condition:
+            return {name: job.stats() for name, job in self.jobs.items()}
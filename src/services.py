@@ -1,41 +1,141 @@
 import datetime
-import requests
 import json
 import math
-import paho.mqtt.publish as publish
+from concurrent.futures import ThreadPoolExecutor
 from itertools import groupby
 
 import thread_helper
+from beacon_registry import BeaconRegistry
+from cache import TTLCache
+from http_client import HTTPClient
+from mqtt import MQTTPublisher
+from push_notification_service import PUSH_SENT, PUSH_INVALID
+from push_scheduler import PushScheduler
+from stop_index import StopIndex
+from stop_requests import StopRequestCounts, StopRequestPublisher
+from trip import Trip
+from vehicles import ActiveVehicles
+
+# Fields of a trip selected for its stoptimes, the service day is filled in with %s
+TRIP_FIELDS = ("  gtfsId"
+               "  stoptimesForDate(serviceDay: \"%s\") {"
+               "      stop {"
+               "          gtfsId"
+               "          name"
+               "          code"
+               "      }"
+               "      serviceDay"
+               "      realtimeArrival"
+               "      arrivalDelay"
+               "  }")
+
+# Stoptimes of a trip, shared by everything that needs realtime arrivals of a trip, see DigitransitAPIService.fetch_trip
+TRIP_QUERY = "{trip(id: \"%s\") {" + TRIP_FIELDS + "}}"
+
+# Seconds before the arrival of the bus the push notification of a stop request is sent
+PUSH_LEAD_TIME = 120
+
+# Trips of a service day may run until early next morning
+SERVICE_DAY_LENGTH = datetime.timedelta(hours=30)
+
+# Selection set of a stop needed to build its schedule, see DigitransitAPIService.parse_stop_schedule
+STOP_SCHEDULE_FIELDS = ("  name"
+                        "  code"
+                        "  vehicleType"
+                        "  stoptimesForServiceDate(date: \"%s\"){"
+                        "     pattern {"
+                        "         code"
+                        "         name"
+                        "         directionId"
+                        "         route {"
+                        "             gtfsId"
+                        "             longName"
+                        "             shortName"
+                        "         }"
+                        "     }"
+                        "     stoptimes {"
+                        "         trip{"
+                        "             gtfsId"
+                        "         }"
+                        "         stopHeadsign"
+                        "         serviceDay"
+                        "    	    realtimeArrival"
+                        "      }"
+                        "    }")
 
-import csv
-import io
 
 class DigitransitAPIService:
-    def __init__(self, db, push_notification_service, hsl_api_url):
+    def __init__(self, db, push_notification_service, hsl_api_url, max_workers=10, batch_queries=False,
+                 http_client=None, stop_cache_size=1000, stop_cache_ttl=15, beacon_registry=None,
+                 fuzzy_trip_cache_size=1000, trip_cache_size=1000, trip_cache_ttl=10, active_vehicles=None,
+                 publisher=None, publish_window=0.5, stop_request_counts=None, push_scheduler=None, push_interval=1,
+                 trip_batch_size=50):
         self.url = hsl_api_url
         self.headers = {'Content-Type': 'application/graphql'}
+        # Keep-alive connections shared by all upstream requests
+        self.http = http_client if http_client else HTTPClient(pool_size=max_workers)
         self.db = db
+        self.active_vehicles = active_vehicles if active_vehicles else ActiveVehicles(db)
         self.MQTT_host = "epsilon.fixme.fi"
+        self.publisher = publisher if publisher else MQTTPublisher(self.MQTT_host)
+        self.stop_request_counts = stop_request_counts if stop_request_counts else StopRequestCounts(db)
+        self.stop_request_publisher = StopRequestPublisher(self.publisher, self.stop_request_counts, publish_window)
         self.push_notification_service = push_notification_service
+        # Requests waiting for a push notification and when their trips are checked next, see notify
+        self.push_scheduler = push_scheduler if push_scheduler is not None else PushScheduler(lead_time=PUSH_LEAD_TIME)
+        self.push_interval = push_interval
+        # Bounded pool for fanning out independent upstream queries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Whether get_stops fetches the nearby stops and their schedules with a single query
+        self.batch_queries = batch_queries
+        # Raw stop data by (stop_id, service date), the arrival times are calculated from it on every request
+        self.stop_cache = TTLCache(maxsize=stop_cache_size, ttl=stop_cache_ttl)
+        # Locations of all stops, radius searches are answered from it once refresh_stop_index has loaded it
+        self.stop_index = StopIndex()
+        self.beacon_registry = beacon_registry if beacon_registry else BeaconRegistry(self.http)
+        # Trips by (route, direction, date, start time), valid until the end of the service day
+        self.fuzzy_trip_cache = TTLCache(maxsize=fuzzy_trip_cache_size)
+        # Stoptimes of trips by (trip_id, service day), shared by routes, request info and push notifications
+        self.trip_cache = TTLCache(maxsize=trip_cache_size, ttl=trip_cache_ttl)
+        # Maximum number of trips selected in one query by fetch_trips
+        self.trip_batch_size = trip_batch_size
+
+    def start(self):
+        """
+        Loads the active vehicles and the stop request counts from the database, connects to the MQTT server and starts
+        the background threads writing the vehicles and publishing the stop requests. Until then the service makes no
+        connections and runs no threads of its own. (Called from stop.py before serving.)
+        """
+        self.active_vehicles.load()
+        self.active_vehicles.writer.start()
+        self.stop_request_counts.load()
+        self.publisher.start()
+        self.stop_request_publisher.start()
 
     def get_stops(self, lat, lon, radius):
         """
         Gets info from all stops within given radius of the point specified by lat and lon, including all the busses
-        going to pass those stops.
+        going to pass those stops. The schedules of the stops are queried concurrently, or if batch_queries is set, with
+        a single query.
 
-        See: get_stops_near_coordinates, get_busses_by_stop_id
+        See: get_stops_near_coordinates, get_busses_by_stop_id, get_stops_batched
 
         :param lat: latitude
         :param lon: longitude
         :param radius: radius
         :return: dict containing info of all the stops within radius and busses scheduled to pass those stops
         """
+        if self.batch_queries:
+            return self.get_stops_batched(lat, lon, radius)
+
         data = {}
         stops = []
         stop_ids = self.get_stops_near_coordinates(lat, lon, radius)
 
-        for stop_id in stop_ids:
-            stops.append({"stop": self.get_busses_by_stop_id(stop_id['stop_id'], stop_id['distance'])})
+        # executor.map yields the results in the order of stop_ids, which is sorted by distance
+        schedules = self.executor.map(lambda s: self.get_busses_by_stop_id(s['stop_id'], s['distance']), stop_ids)
+        for schedule in schedules:
+            stops.append({"stop": schedule})
 
         data["stops"] = stops
         return data
@@ -45,19 +145,13 @@ class DigitransitAPIService:
         Gets stop info with iBeacons identifying major and minor values, including busses that are going to pass given
         stop. Uses csv file provided in 'https://dev.hsl.fi/tmp/stop_beacons.csv' to match major and minor to stop code.
 
-        See: get_stops_by_code
+        See: get_stops_by_code, BeaconRegistry (in beacon_registry.py)
 
         :param major: identifies iBeacon together with minor
         :param minor: identifies iBeacon together with major
         :return: dict containing info of the stop including busses that are scheduled to pass it
         """
-        beacons = {}
-        beacon_csv = requests.get("https://dev.hsl.fi/tmp/stop_beacons.csv").text
-        reader = csv.DictReader(io.StringIO(beacon_csv))
-        for beacon in reader:
-            beacons[(int(beacon['Major']), int(beacon['Minor']))] = beacon
-
-        beacon = beacons.get((major, minor))
+        beacon = self.beacon_registry.get_stop_beacon(major, minor)
         if not beacon: # XXX unknown beacon, fake a location for now
             beacon_coords = {'lat': 60.203978, 'lon': 24.9633573}
             return self.get_stops(beacon_coords.get('lat'), beacon_coords.get('lon'), 160)
@@ -70,29 +164,24 @@ class DigitransitAPIService:
     def get_busses_with_beacon(self, major_minor):
         """
         Gets info of all the busses related to given list of majors and minors. Uses csv file provided in
-        'https://dev.hsl.fi/tmp/bus_beacons.csv' to match major and minors to bus code. Then gets that busses route,
-        direction and time data from 'https://dev.hsl.fi/hfp/journey/bus/{bus_code}/'. Finally fetches trip info with
-        fetch_single_fuzzy_trip using that data.
+        'https://dev.hsl.fi/tmp/bus_beacons.csv' to match major and minors to bus code. Then looks up the trips of the
+        busses concurrently, each bus only once even if many of its beacons are given.
 
-        See: fetch_single_fuzzy_trip
+        See: get_bus_by_vehicle, BeaconRegistry (in beacon_registry.py)
 
         :param major_minor: List of the following form: [ { "major":"X", "minor":"Y"},... ]
-        :return: dict containing bus info including major, minor and EITHER trip_id, direction, line OR error
+        :return: dict containing bus info including major, minor and EITHER trip_id, direction, line OR error, in the
+            order of major_minor
         """
         result = dict()
         result['vehicles'] = []
 
-        beacons = dict()
-
-        csvdata = requests.get('http://dev.hsl.fi/tmp/bus_beacons.csv').text
-        reader = csv.DictReader(io.StringIO(csvdata))
-
-        for row in reader:
-            beacons[(row['Major'], row['Minor'])] = row
+        lookups = {}  # Lookups of the vehicles by vehicle code
+        vehicles = []  # Results, or lookups and beacons of the results, in the order of major_minor
 
         for mm in major_minor:
             if mm.get('major') == 12345 and mm.get('minor') == 12345:
-                result['vehicles'].append(json.loads('''{"major":12345,
+                vehicles.append(json.loads('''{"major":12345,
                                    "minor":12345,
                                    "trip_id":"1055_20161031_Ma_2_1359",
                                    "destination":"Rautatientori via Kalasatama(M)",
@@ -100,40 +189,64 @@ class DigitransitAPIService:
                                    "vehicle_type":3}'''))
                 continue
 
-            row = beacons.get((mm['major'], mm['minor']))
+            row = self.beacon_registry.get_bus_beacon(mm['major'], mm['minor'])
 
             if not row:
-                result['vehicles'].append(json.loads(('''{"error":"Invalid major and/or minor", "major":%d, "minor":%d}''') % (mm['major'], mm['minor'])))
-            else:
-                if not row['Vehicle']:
-                    continue
-                json_data = json.loads(requests.get(('https://dev.hsl.fi/hfp/journey/bus/%s/') % (row['Vehicle'])).text)
+                vehicles.append(json.loads(('''{"error":"Invalid major and/or minor", "major":%d, "minor":%d}''') % (mm['major'], mm['minor'])))
+            elif row['Vehicle']:
+                if row['Vehicle'] not in lookups:
+                    lookups[row['Vehicle']] = self.executor.submit(self.get_bus_by_vehicle, row['Vehicle'])
+                vehicles.append((lookups[row['Vehicle']], mm))
+
+        for vehicle in vehicles:
+            if isinstance(vehicle, dict):
+                result['vehicles'].append(vehicle)
+                continue
+
+            lookup, mm = vehicle
+            bus = lookup.result()
+            if bus is None:
+                result['vehicles'].append(json.loads(('''{"error":"No realtime data from the bus", "major":%d, "minor":%d}''') % (mm['major'], mm['minor'])))
+                continue
 
-                # The above API returns empty json object if there is not available realtime data of the bus
-                if json_data == json.loads("{}"):
-                    result['vehicles'].append(json.loads(('''{"error":"No realtime data from the bus", "major":%d, "minor":%d}''') % (mm['major'], mm['minor'])))
-                    continue
+            data = dict(bus)  # Beacons of the same bus share the lookup
+            data['major'] = mm['major']
+            data['minor'] = mm['minor']
+            data['vehicle_type'] = 3            # For now always assumes vehicle is a bus
+            result['vehicles'].append(data)
 
-                bus = json_data[list(json_data)[0]]['VP']
+        return result
 
-                route = "HSL:" + bus['line']
-                direction = int(bus['dir'])
-                date = datetime.datetime.fromtimestamp(float(bus['tsi'])).strftime("%Y%m%d")
-                time = math.floor( (int(bus['start'])/100) * 60) + (int(bus['start']) % 60) * 60
+    def get_bus_by_vehicle(self, vehicle):
+        """
+        Gets route, direction and time data of the bus from 'https://dev.hsl.fi/hfp/journey/bus/{bus_code}/' and fetches
+        trip info with fetch_single_fuzzy_trip using that data.
 
-                data = self.fetch_single_fuzzy_trip(route, direction, date, time)
+        See: fetch_single_fuzzy_trip
 
-                data['major'] = mm['major']
-                data['minor'] = mm['minor']
-                data['vehicle_type'] = 3            # For now always assumes vehicle is a bus
-                result['vehicles'].append(data)
+        :param vehicle: bus code
+        :return: dict containing EITHER trip_id, direction, line OR error, None if there is no realtime data of the bus
+        """
+        json_data = json.loads(self.http.get(('https://dev.hsl.fi/hfp/journey/bus/%s/') % (vehicle)).text)
 
-        return result
+        # The above API returns empty json object if there is not available realtime data of the bus
+        if json_data == json.loads("{}"):
+            return None
+
+        bus = json_data[list(json_data)[0]]['VP']
+
+        route = "HSL:" + bus['line']
+        direction = int(bus['dir'])
+        date = datetime.datetime.fromtimestamp(float(bus['tsi'])).strftime("%Y%m%d")
+        time = math.floor( (int(bus['start'])/100) * 60) + (int(bus['start']) % 60) * 60
+
+        return self.fetch_single_fuzzy_trip(route, direction, date, time)
 
 
     def fetch_single_fuzzy_trip(self, route, direction, date, time):
         """
-        Gets trip info from Digitransit API. See: get_query
+        Gets trip info from Digitransit API. The trip of a departure doesn't change, so it is cached until the end of
+        the service day, and concurrent requests for the same departure share a single query. See: get_query
 
         :param route: route number
         :param direction: direction
@@ -150,7 +263,11 @@ class DigitransitAPIService:
                     }
                 }''') % (route, date, time, direction)
 
-        data = json.loads(self.get_query(query))['data']['fuzzyTrip']
+        service_day_end = datetime.datetime.strptime(date, "%Y%m%d") + SERVICE_DAY_LENGTH
+        ttl = (service_day_end - datetime.datetime.now()).total_seconds()
+        data = self.fuzzy_trip_cache.get_or_load((route, direction, date, time),
+                                                 lambda: json.loads(self.get_query(query))['data']['fuzzyTrip'],
+                                                 ttl=ttl)
 
         if data is None:
             return json.loads('{"error":"No trip found matching route, direction, date and time"}')
@@ -160,7 +277,8 @@ class DigitransitAPIService:
 
     def get_stops_near_coordinates(self, lat, lon, radius):
         """
-        Gets stops within specified radius of a point defined by lat and lon from Digitransit API. See: get_query
+        Gets stops within specified radius of a point defined by lat and lon from the stop index, or from Digitransit
+        API if the index isn't loaded. See: get_query, refresh_stop_index
 
         :param lat: latitude
         :param lon: longitude
@@ -168,6 +286,12 @@ class DigitransitAPIService:
         :return: list of stops including ids and their distance to point defined by lat and lon
         """
         radius = min(radius, 1000)
+        stoplist = []
+        if self.stop_index.loaded:
+            for n in self.select_nearest_stops(self.stop_index.find(lat, lon, radius)):
+                stoplist.append({'stop_id': n['stop']['gtfsId'], 'distance': n['distance']})
+            return stoplist
+
         query = ("{stopsByRadius(lat:%f, lon:%f, radius:%d) {"
                  "  edges {"
                  "      node {"
@@ -183,60 +307,142 @@ class DigitransitAPIService:
                  "}") % (lat, lon, radius)
         data = json.loads(self.get_query(query))
         data = data['data']['stopsByRadius']['edges']
-        stoplist = []
-        for n in data:
+        for n in self.select_nearest_stops(data):
+            stoplist.append({'stop_id': n['stop']['gtfsId'], 'distance': n['distance']})
+        return stoplist
+
+    def select_nearest_stops(self, edges):
+        """
+        Picks the three nearest tram and bus stops from the edges of a stopsByRadius query.
+
+        :param edges: edges of a stopsByRadius query
+        :return: list of at most three nodes containing distance and stop, sorted by distance
+        """
+        nodes = []
+        for n in edges:
             if n['node']['stop']['vehicleType'] == 0 or n['node']['stop']['vehicleType'] == 3:      #vehicle_type: 0 - tram, 1 - metro, 3 - bus, 4 - ferry
-                stoplist.append({'stop_id': n['node']['stop']['gtfsId'], 'distance': n['node']['distance']})
-        sorted(stoplist, key=lambda k: k['distance'])
-        return stoplist[:3]
+                nodes.append(n['node'])
+        nodes.sort(key=lambda k: k['distance'])
+        return nodes[:3]
+
+    def get_stops_batched(self, lat, lon, radius):
+        """
+        Same as get_stops, but fetches the schedules of the nearest stops with a single query instead of one query per
+        stop. Only the schedules which aren't cached are fetched. See: get_stops_near_coordinates, fetch_stops,
+        parse_stop_schedule
+
+        :param lat: latitude
+        :param lon: longitude
+        :param radius: radius
+        :return: dict containing info of all the stops within radius and busses scheduled to pass those stops
+        """
+        stops = []
+        stop_ids = self.get_stops_near_coordinates(lat, lon, radius)
+        stop_data = self.fetch_stops([s['stop_id'] for s in stop_ids])
+        for s in stop_ids:
+            data = stop_data.get(s['stop_id'])
+            if data is None:
+                stops.append({"stop": json.loads('{ "error":"Invalid stop id" }')})
+            else:
+                stops.append({"stop": self.parse_stop_schedule(s['stop_id'], s['distance'], data)})
+        return {"stops": stops}
 
     def get_busses_by_stop_id(self, stop_id, distance):
         """
-        Gets info from busses passing stop identified by stop_id from Digitransit API. See: get_query
+        Gets info from busses passing stop identified by stop_id from Digitransit API. See: fetch_stop
 
         :param stop_id: stop id
         :param distance: distance appended to the result
         :return: dict containing info from both the stop and the busses passing it
         """
-        query = ("{stop(id: \"%s\") {"
-                 "  name"
-                 "  code"
-                 "  vehicleType"
-                 "  stoptimesForServiceDate(date: \"%s\"){"
-                 "     pattern {"
-                 "         code"
-                 "         name"
-                 "         directionId"
-                 "         route {"
-                 "             gtfsId"
-                 "             longName"
-                 "             shortName"
-                 "         }"
-                 "     }"
-                 "     stoptimes {"
-                 "         trip{"
-                 "             gtfsId"
-                 "         }"
-                 "         stopHeadsign"
-                 "         serviceDay"
-                 "    	    realtimeArrival"
-                 "      }"
-                 "    }"
-                 "  }"
-                 "}") % (stop_id, datetime.datetime.now().strftime("%Y%m%d"))
-
-        data = json.loads(self.get_query(query))["data"]["stop"]
+        data = self.fetch_stop(stop_id)
 
         if data is None:
             return json.loads('{ "error":"Invalid stop id" }')
 
+        return self.parse_stop_schedule(stop_id, distance, data)
+
+    def fetch_stop(self, stop_id):
+        """
+        Gets the stop data needed for building the schedule of the stop from Digitransit API. The data is cached for a
+        short while, as there are usually many users at the same stop. See: get_query
+
+        :param stop_id: stop id
+        :return: stop data selected with STOP_SCHEDULE_FIELDS, None if the stop doesn't exist
+        """
+        date = datetime.datetime.now().strftime("%Y%m%d")
+        data = self.stop_cache.get((stop_id, date))
+        if data is not None:
+            return data
+
+        query = ("{stop(id: \"%s\") {%s  }}") % (stop_id, STOP_SCHEDULE_FIELDS % date)
+        data = json.loads(self.get_query(query))["data"]["stop"]
+        if data is not None:
+            self.stop_cache.set((stop_id, date), data)
+        return data
+
+    def fetch_stops(self, stop_ids):
+        """
+        Same as fetch_stop for many stops. The stops which aren't cached are fetched with a single query, where every
+        stop is selected under its own alias. See: get_query
+
+        :param stop_ids: list of stop ids
+        :return: dict where result[stop_id] = stop data selected with STOP_SCHEDULE_FIELDS, stops that don't exist are
+            left out
+        """
+        date = datetime.datetime.now().strftime("%Y%m%d")
+        result = {}
+        missing = []
+        for stop_id in stop_ids:
+            data = self.stop_cache.get((stop_id, date))
+            if data is None:
+                missing.append(stop_id)
+            else:
+                result[stop_id] = data
+        if not missing:
+            return result
+
+        query = "{%s}" % "".join(("s%d: stop(id: \"%s\") {%s  } " % (i, stop_id, STOP_SCHEDULE_FIELDS % date))
+                                 for i, stop_id in enumerate(missing))
+        data = json.loads(self.get_query(query))["data"]
+        for i, stop_id in enumerate(missing):
+            stop = data.get("s%d" % i)
+            if stop is not None:
+                self.stop_cache.set((stop_id, date), stop)
+                result[stop_id] = stop
+        return result
+
+    def refresh_stop_index(self):
+        """
+        Loads the locations of all stops from Digitransit API to the stop index. Keeps the previously loaded stops if
+        the query fails. (Called periodically from stop.py, see thread_helper.py)
+
+        See: get_query, StopIndex (in stop_index.py)
+        """
+        query = "{stops { gtfsId lat lon vehicleType } }"
+        try:
+            data = json.loads(self.get_query(query))['data']['stops']
+        except Exception as e:
+            print("Refreshing the stop index failed:", e)
+            return
+        self.stop_index.load(data)
+
+    def parse_stop_schedule(self, stop_id, distance, data):
+        """
+        Builds the schedule of a stop from the stop data returned by Digitransit API. Only the busses arriving within an
+        hour are included, at most two per route and ten in total.
+
+        :param stop_id: stop id
+        :param distance: distance appended to the result
+        :param data: stop data selected with STOP_SCHEDULE_FIELDS
+        :return: dict containing info from both the stop and the busses passing it
+        """
         lines = data["stoptimesForServiceDate"]
 
         current_time = datetime.datetime.now()
 
         stop = {'stop_name': data["name"], 'stop_code': data["code"], 'stop_id': stop_id, 'distance': distance, 'schedule': []}
         schedule = []
-        active_vehicles = self.db.get_vehicles()
 
         for line in lines:
             stoptimes = line["stoptimes"]
@@ -247,7 +453,7 @@ class DigitransitAPIService:
                 arrival_time = datetime.datetime.fromtimestamp(time["serviceDay"] + time["realtimeArrival"])
                 arrival = math.floor((arrival_time - current_time).total_seconds() / 60.0)  # Arrival in minutes
                 if current_time < arrival_time and arrival < 61:
-                    if time.get("trip").get("gtfsId") in active_vehicles:
+                    if time.get("trip").get("gtfsId") in self.active_vehicles:
                         supports_stop_requests = True
                     else:
                         supports_stop_requests = False
@@ -283,7 +489,7 @@ class DigitransitAPIService:
         :param query: graphQL-query
         :return: JSON string response from API
         """
-        response = requests.post(self.url, data=query, headers=self.headers)
+        response = self.http.post(self.url, data=query, headers=self.headers)
 
         # Force encoding as auto-detection sometimes fails
         response.encoding = 'utf-8'
@@ -291,12 +497,35 @@ class DigitransitAPIService:
             print("ERROR:", response.text)
         return response.text
 
+    def get_metrics(self):
+        """
+        Gathers runtime statistics of the service.
+
+        :return: dict containing statistics of the upstream HTTP connections, database connections and caches
+        """
+        return {"http": self.http.stats(),
+                "database": self.db.stats(),
+                "stop_cache": self.stop_cache.stats(),
+                "stop_index": {"size": self.stop_index.size},
+                "beacons": self.beacon_registry.stats(),
+                "fuzzy_trip_cache": self.fuzzy_trip_cache.stats(),
+                "trip_cache": self.trip_cache.stats(),
+                "active_vehicles": self.active_vehicles.stats(),
+                "vehicle_writer": self.active_vehicles.writer.stats(),
+                "mqtt_publisher": self.publisher.stats(),
+                "stop_request_publisher": self.stop_request_publisher.stats(),
+                "stop_requests": self.stop_request_counts.stats(),
+                "scheduler": thread_helper.scheduler.stats(),
+                "push": self.push_notification_service.stats(),
+                "push_scheduler": self.push_scheduler.stats()}
+
     def make_request(self, trip_id, stop_id, device_id, push_notification):
         """
-        Saves stop request to database. If push notification is wanted tries to start running notify-method in 30 second
-        intervals. (Does not start if it's already running.)
+        Saves stop request to database and publishes the changed stop requests of the trip. If push notification is
+        wanted adds the request to the push scheduler and tries to start running notify-method. (Does not start if it's
+        already running.)
 
-        See: notify
+        See: notify, StopRequestPublisher (in stop_requests.py), PushScheduler (in push_scheduler.py)
 
         :param trip_id: trip id
         :param stop_id: stop id
@@ -306,60 +535,56 @@ class DigitransitAPIService:
         """
         request_id = self.db.store_request(trip_id, stop_id, device_id, push_notification)
 
-        data = self.get_requests(trip_id)
-        publish.single(topic="stoprequests/" + trip_id, payload=json.dumps(data), hostname=self.MQTT_host, port=1883)
+        self.stop_request_counts.add(trip_id, stop_id)
+        self.stop_request_publisher.trip_changed(trip_id)
 
         result = {"request_id": request_id}
-        if push_notification:
-            thread_helper.start_do_every("PUSH", 30, self.notify)
+        if push_notification and device_id != '0':  # Requests of device '0' are stored as pushed
+            self.push_scheduler.add(trip_id, request_id, stop_id, device_id)
+            thread_helper.start_do_every("PUSH", self.push_interval, self.notify)
         return result
 
     def get_request_info(self, request_id):
         """
-        Gets info of the trip related to given request id from Digitransit API. See: get_query
+        Gets info of the trip related to given request id from Digitransit API. See: fetch_trip
 
         :param request_id: id of the stoprequest
         :return: dict containing stop_name, stop_code, stop_id, arrives_in, delay
         """
         request_data = self.db.get_request_info(request_id)
 
-        query = ("{"
-                 "  trip(id: \"%s\"){"
-                 "      stoptimesForDate(serviceDay: \"%s\"){"
-                 "          stop{"
-                 "              gtfsId"
-                 "              code"
-                 "              name"
-                 "          }"
-                 "          serviceDay"
-                 "          realtimeArrival"
-                 "          arrivalDelay"
-                 "      }"
-                 "  }"
-                 "}") % (request_data[0], datetime.datetime.now().strftime("%Y%m%d"))
+        trip = self.fetch_trip(request_data[0])
+        if trip is None:
+            return {}
 
-        stop_data = json.loads(self.get_query(query))['data']['trip']['stoptimesForDate']
         result = {}
-        for stop in stop_data:
-            if request_data[1] == stop['stop']['gtfsId']:
-                current_time = datetime.datetime.now()
-                real_time = datetime.datetime.fromtimestamp(stop["serviceDay"] + stop["realtimeArrival"])
-                arrival = math.floor((real_time - current_time).total_seconds() / 60.0)
-                result = {'stop_name': stop['stop']['name'], 'stop_code': stop['stop']['code'],
-                          'stop_id': stop['stop']['gtfsId'], 'arrives_in': arrival, 'delay': stop['arrivalDelay']}
+        for stop in trip.stoptimes_at(request_data[1]):
+            current_time = datetime.datetime.now()
+            real_time = Trip.arrival_time(stop)
+            arrival = math.floor((real_time - current_time).total_seconds() / 60.0)
+            result = {'stop_name': stop['stop']['name'], 'stop_code': stop['stop']['code'],
+                      'stop_id': stop['stop']['gtfsId'], 'arrives_in': arrival, 'delay': stop['arrivalDelay']}
 
         return result
 
     def cancel_request(self, request_id):
         """
-        Cancels stoprequest with the given id. See: get_requests
+        Cancels stoprequest with the given id and publishes the changed stop requests of the trip.
+
+        See: StopRequestPublisher (in stop_requests.py)
 
         :param request_id:
         :return: empty string
         """
-        trip_id = self.db.cancel_request(request_id)
-        data = self.get_requests(trip_id)
-        publish.single(topic="stoprequests/" + trip_id, payload=json.dumps(data), hostname=self.MQTT_host, port=1883)
+        canceled = self.db.cancel_request(request_id)
+        if canceled is None:  # No such request or already canceled
+            return ''
+
+        trip_id, stop_id = canceled
+        self.push_scheduler.remove(trip_id, request_id)
+        self.push_scheduler.done(request_id)
+        self.stop_request_counts.remove(trip_id, stop_id)
+        self.stop_request_publisher.trip_changed(trip_id)
 
         return ''
 
@@ -377,55 +602,30 @@ class DigitransitAPIService:
 
     def get_requests(self, trip_id):
         """
-        Gets all requests related to trip id from the database.
+        Gets the number of passengers at each stop of the trip. See: StopRequestCounts (in stop_requests.py)
 
         :param trip_id:
         :return: dict containing stop_ids of all stoprequests related to trip_id
         """
-        requests = self.db.get_requests(trip_id)
-        stop_dict = {}
-
-        for stop_id in requests:
-            i = stop_dict.get(stop_id[0], 0)
-            stop_dict[stop_id[0]] = i + 1
-        stop_list = []
-
-        for key in stop_dict.keys():
-            stop_list.append({"id": key, "passengers": stop_dict[key]})
-
-        return {"stop_ids": stop_list}
+        return self.stop_request_counts.get(trip_id)
 
     def get_stops_by_trip_id(self, trip_id):
         """
-        Gets stops on the route of trip identified by trip_id from Digitransit API. See: get_query
+        Gets stops on the route of trip identified by trip_id from Digitransit API. See: fetch_trip
 
         :param trip_id:
         :return: dict containing list of stops which include stop_name, stop_code, stop_id, arrives_in
         """
-        query = ("{trip(id: \"%s\") {"
-                 " stoptimesForDate(serviceDay: \"%s\") {"
-                 "      stop{"
-                 "          gtfsId"
-                 "          name"
-                 "          code"
-                 " }"
-                 "      serviceDay"
-                 "      realtimeArrival"
-                 "        }"
-                 "       }"
-                 "      }"
-                 "}") % (trip_id, datetime.datetime.now().strftime("%Y%m%d"))
-
         current_time = datetime.datetime.now()
         result = {}
         stops = []
-        data = json.loads(self.get_query(query))['data']['trip']
+        data = self.fetch_trip(trip_id)
 
         if data is None:
             return json.loads('{ "error":"Invalid trip id" }')
 
-        for stop in data['stoptimesForDate']:
-            real_time = datetime.datetime.fromtimestamp(stop["serviceDay"] + stop["realtimeArrival"])
+        for stop in data.stoptimes:
+            real_time = Trip.arrival_time(stop)
             arrival = math.floor((real_time - current_time).total_seconds() / 60.0)
             stops.append({'stop_name': stop['stop']['name'], 'stop_code': stop['stop']['code'],
                           'stop_id': stop['stop']['gtfsId'], 'arrives_in': arrival})
@@ -435,40 +635,25 @@ class DigitransitAPIService:
 
     def get_single_stop_by_trip_id(self, trip_id, stop_id):
         """
-        Gets info of a single stop on route of trip identified by trip_id from Digitransit API. See: get_query
+        Gets info of a single stop on route of trip identified by trip_id from Digitransit API. See: fetch_trip
 
         :param trip_id:
         :param stop_id:
         :return: dict containing list with single stop with stop_name, stop_code, stop_id, arrives_in
         """
-        query = ("{trip(id: \"%s\") {"
-                 " stoptimesForDate(serviceDay: \"%s\") {"
-                 "      stop{"
-                 "          gtfsId"
-                 "          name"
-                 "          code"
-                 " }"
-                 "      serviceDay"
-                 "      realtimeArrival"
-                 "        }"
-                 "       }"
-                 "      }"
-                 "}") % (trip_id, datetime.datetime.now().strftime("%Y%m%d"))
-
         current_time = datetime.datetime.now()
         result = {}
         stops = []
-        data = json.loads(self.get_query(query))['data']['trip']
+        data = self.fetch_trip(trip_id)
 
         if data is None:
             return json.loads('{ "error":"Invalid trip id" }')
 
-        for stop in data['stoptimesForDate']:
-            if stop_id == stop['stop']['gtfsId']:
-                real_time = datetime.datetime.fromtimestamp(stop["serviceDay"] + stop["realtimeArrival"])
-                arrival = math.floor((real_time - current_time).total_seconds() / 60.0)
-                stops.append({'stop_name': stop['stop']['name'], 'stop_code': stop['stop']['code'],
-                                  'stop_id': stop['stop']['gtfsId'], 'arrives_in': arrival})
+        for stop in data.stoptimes_at(stop_id):
+            real_time = Trip.arrival_time(stop)
+            arrival = math.floor((real_time - current_time).total_seconds() / 60.0)
+            stops.append({'stop_name': stop['stop']['name'], 'stop_code': stop['stop']['code'],
+                          'stop_id': stop['stop']['gtfsId'], 'arrives_in': arrival})
         result["stops"] = stops
 
         return result
@@ -486,103 +671,231 @@ class DigitransitAPIService:
 
     def fetch_single_trip(self, trip_id):
         """
-        Get info of single trip identified by trip_id from Digitransit API. See: get_query
+        Get info of single trip identified by trip_id from Digitransit API. See: fetch_trip
 
         :param trip_id:
-        :return:
+        :return: dict where result['trip'] = Trip, None if the trip doesn't exist
         """
-        query = ('''{ trip(id:"%s"){
-                        gtfsId
-                        stoptimesForDate(serviceDay:"%s"){
-                            serviceDay
-                            realtimeArrival
-                            stop{
-                                gtfsId
-                            }
-                            }
-                        }
-                    }''') % (trip_id, datetime.datetime.now().strftime("%Y%m%d"))
+        return {'trip': self.fetch_trip(trip_id)}
 
-        data = json.loads(self.get_query(query))
+    def fetch_trip(self, trip_id):
+        """
+        Gets the realtime stoptimes of trip identified by trip_id from Digitransit API. The stoptimes are cached for a
+        few seconds and concurrent requests for the same trip share a single query, so the routes, the stoprequest info
+        and the push notifications of a trip are served with one query per refresh. See: get_query, Trip (in trip.py)
 
-        return data['data']
+        :param trip_id:
+        :return: Trip, None if the trip doesn't exist
+        """
+        date = datetime.datetime.now().strftime("%Y%m%d")
+        return self.trip_cache.get_or_load((trip_id, date), lambda: self.load_trip(TRIP_QUERY % (trip_id, date)))
+
+    def load_trip(self, query):
+        data = json.loads(self.get_query(query))['data']['trip']
+        return Trip(data) if data is not None else None
+
+    def trip_cached(self, trip_id):
+        """
+        :return: True if the stoptimes of the trip are cached, i.e. fetching them makes no query
+        """
+        return (trip_id, datetime.datetime.now().strftime("%Y%m%d")) in self.trip_cache
+
+    def fetch_trips(self, trip_ids):
+        """
+        Same as fetch_trip for many trips. The trips which aren't cached are fetched with queries of at most
+        trip_batch_size trips, where every trip is selected under its own alias, and the queries are run concurrently.
+        So the cached trips make no query and the others ceil(count / trip_batch_size) queries, which is what the
+        budget of the push scheduler is spent by, see notify. See: trips_query
+
+        :param trip_ids: list of trip ids
+        :return: dict where result[trip_id] = Trip, None if the trip doesn't exist. The trips whose query failed are
+            left out.
+        """
+        date = datetime.datetime.now().strftime("%Y%m%d")
+        result = {}
+        missing = []
+        for trip_id in trip_ids:
+            trip = self.trip_cache.get((trip_id, date))
+            if trip is None:
+                missing.append(trip_id)
+            else:
+                result[trip_id] = trip
+
+        futures = [self.executor.submit(self.load_trips, missing[i:i + self.trip_batch_size], date)
+                   for i in range(0, len(missing), self.trip_batch_size)]
+        for future in futures:
+            try:
+                result.update(future.result())
+            except Exception as e:
+                print("Fetching trips failed:", e)
+        return result
+
+    def load_trips(self, trip_ids, date):
+        """
+        Fetches the trips with one query and caches them.
+
+        :return: dict where result[trip_id] = Trip, None if the trip doesn't exist
+        """
+        if len(trip_ids) == 1:
+            return {trip_ids[0]: self.fetch_trip(trip_ids[0])}
+
+        data = json.loads(self.get_query(self.trips_query(trip_ids, date)))['data']
+        result = {}
+        for i, trip_id in enumerate(trip_ids):
+            trip = data.get("t%d" % i)
+            result[trip_id] = Trip(trip) if trip is not None else None
+            if trip is not None:
+                self.trip_cache.set((trip_id, date), result[trip_id])
+        return result
+
+    def trips_query(self, trip_ids, date):
+        """
+        :param trip_ids: list of trip ids
+        :param date: service date
+        :return: query selecting the stoptimes of every trip with TRIP_FIELDS under alias t<index in trip_ids>
+        """
+        return "{%s}" % "".join(("t%d: trip(id: \"%s\") {%s} " % (i, trip_id, TRIP_FIELDS % date))
+                                for i, trip_id in enumerate(trip_ids))
+
+    def load_pushable_requests(self):
+        """
+        Loads the requests waiting for a push notification to the push scheduler and starts notify if there are any.
+        (Called at startup.)
+
+        See: fetch_pushable_requests, notify
+        """
+        self.push_scheduler.load(self.fetch_pushable_requests())
+        if len(self.push_scheduler):
+            thread_helper.start_do_every("PUSH", self.push_interval, self.notify)
 
     def notify(self):
         """
-        (Called from make_request, after which will run every 30 seconds until environment variable PUSH is set to STOP.)
-        Fetches all stoprequests, where push notification is not yet sent and calls
-        fetch_trips_and_send_push_notifications. If all stoprequests have been served, sets environment variable
-        PUSH to STOP which stops running this function.
+        (Started from make_request, after which will run every push_interval seconds as worker PUSH until it stops
+        itself.) Takes the trips whose check is due from the push scheduler and calls
+        fetch_trips_and_send_push_notifications for them, which fetches them with a few batched queries. The budget of
+        the push scheduler is spent per query of those, cached trips cost nothing. Each trip is checked again sooner the
+        closer its bus is to the stops of its requests, so trips far away cost few queries. If all requests have been
+        served, stops worker PUSH, unless a request wanting a push notification was made meanwhile.
 
-        See: fetch_pushable_requests, fetch_trips_and_send_push_notifications, thread_helper.py
+        See: fetch_trips_and_send_push_notifications, PushScheduler (in push_scheduler.py), thread_helper.py
         """
-        pushable_requests = self.fetch_pushable_requests()
-        if not pushable_requests:
+        stoprequests = self.push_scheduler.due(self.trip_cached, self.trip_batch_size)
+        if stoprequests:
+            self.fetch_trips_and_send_push_notifications(stoprequests)
+        if not len(self.push_scheduler):
             thread_helper.stop_do_every("PUSH")
-            return
-        pushed_requests = self.fetch_trips_and_send_push_notifications(pushable_requests)
-        # still need some kind of evaluation wether the notifications were sent
-        if pushed_requests:
-            self.db.set_pushed(pushed_requests)
-
 
     def fetch_trips_and_send_push_notifications(self, stoprequests):
         """
         Fetches trips related to stoprequests given to it as a list as parameter, gets trip info related to those
-        stoprequests from Digitransit API and sends push notifications to users whose bus is estimated to arrive in
-        under two minutes. In case of invalid requests (due to invalid trip_id or stop_id), sends push notification
-        notifying about it.
+        stoprequests from Digitransit API with batched queries and sends push notifications to users whose bus is
+        estimated to arrive in under two minutes. In case of invalid requests (due to invalid trip_id or stop_id), sends
+        push notification notifying about it. The due requests are removed from the push scheduler and their
+        notifications queued to PushNotificationService, and the requests are marked pushed once their notifications
+        have been sent. The next checks of the trips are scheduled from the arrivals of their remaining requests.
 
-        See: fetch_single_trip, PushNotificationService (in push_notification_service.py)
+        See: fetch_trips, check_trip, push_sent, PushNotificationService (in push_notification_service.py)
 
         :param stoprequests: dict where stoprequests[trip_id] = [ (request_id_1, stop_id_1, device_id_1), ... ]
-        :return: dict containing info on the sent notifications
+        :return: list of ids of the requests whose push notifications were queued
         """
+        trips = self.fetch_trips(list(stoprequests.keys()))
         current_time = datetime.datetime.now()
-        to_send = [] # List of push notifications to be sent
-        pushed_requests = [] # List of ids of pushed requests
-
-        # stoprequests is dict where:
-        # stoprequests[trip_id] = [ (request_id_1, stop_id_1, device_id_1), ... ]
-        for trip_id in stoprequests.keys():
-            data = self.fetch_single_trip(trip_id)
-
-            # In case trip_id is invalid (cancels invalid requests and send push_notifications of error)
-            if data['trip'] is None:
-                error_notifications = []
-                for sr in stoprequests[trip_id]:
-                    self.cancel_request(sr[0])
-                    error_notifications.append(sr[2])
-                self.push_notification_service.send_error_push_notifications(error_notifications, 'Invalid trip_id!')
+        to_send = []  # List of (trip_id, request_id, stop_id, device_id) of the push notifications to be sent
+
+        for trip_id, requests in stoprequests.items():
+            arrives_in = None
+            try:
+                if trip_id not in trips:
+                    raise ValueError("query failed")
+                due, arrives_in = self.check_trip(trip_id, trips[trip_id], requests, current_time)
+                for sr in due:
+                    self.push_scheduler.remove(trip_id, sr[0])
+                    to_send.append((trip_id,) + tuple(sr))
+            except Exception as e:
+                # The trip is checked again soon, the other trips are still served
+                print("Checking trip", trip_id, "failed:", e)
+            self.push_scheduler.checked(trip_id, arrives_in)
+
+        if len(to_send) != 0:
+            self.push_notification_service.queue_push_notifications(
+                [sr[3] for sr in to_send], lambda outcomes: self.push_sent(to_send, outcomes))
+
+        return [sr[1] for sr in to_send]
+
+    def check_trip(self, trip_id, trip, requests, current_time):
+        """
+        Finds the requests of a trip whose bus arrives at their stop in under PUSH_LEAD_TIME seconds. Cancels the
+        requests of an invalid trip, or of a stop not on the route of the trip, and sends push notification notifying
+        about it.
+
+        :param trip_id: trip id
+        :param trip: Trip, None if the trip doesn't exist
+        :param requests: list of (request_id, stop_id, device_id)
+        :param current_time: datetime the arrivals are compared to
+        :return: tuple of list of the due requests and seconds until the first arrival of the other requests, None if
+            there are no other requests
+        """
+        # In case trip_id is invalid (cancels invalid requests and send push_notifications of error)
+        if trip is None:
+            error_notifications = []
+            for sr in requests:
+                self.cancel_request(sr[0])
+                error_notifications.append(sr[2])
+            self.push_notification_service.queue_error_push_notifications(error_notifications, 'Invalid trip_id!')
+            return [], None
+
+        due = []
+        arrives_in = None
+        for sr in requests:
+            # sr[0] = request_id, sr[1] = stop_id, sr[2] = device_id
+            stoptimes = trip.stoptimes_at(sr[1])
+
+            # In case stop_id was invalid, i.e. not on the route of the trip (cancels invalid request and send
+            # push_notification of error)
+            if not stoptimes:
+                self.cancel_request(sr[0])
+                self.push_notification_service.queue_error_push_notifications([sr[2]], 'Invalid stop_id!')
                 continue
 
-            for sr in stoprequests[trip_id]:
-                found = False # Whether wanted stop_id is on the route of the trip
-                # sr[0] = request_id, sr[1] = stop_id, sr[2] = device_id
-                for stoptime in data['trip']['stoptimesForDate']:
-                    if stoptime['stop']['gtfsId'] == sr[1]:
-                        found = True
-                        arrival_time = datetime.datetime.fromtimestamp(stoptime['serviceDay'] + stoptime['realtimeArrival'])
-                        arrival = math.floor((arrival_time - current_time).total_seconds())
-                        if arrival <= 120:
-                            to_send.append(sr[2])
-                            pushed_requests.append(sr[0])
-
-                # In case stop_id was invalid (cancels invalid request and send push_notification of error)
-                if not found:
-                    self.cancel_request(sr[0])
-                    self.push_notification_service.send_error_push_notifications([sr[2]], 'Invalid stop_id!')
+            arrival = min(math.floor((Trip.arrival_time(stoptime) - current_time).total_seconds())
+                          for stoptime in stoptimes)
+            if arrival <= PUSH_LEAD_TIME:
+                due.append(sr)
+            elif arrives_in is None or arrival < arrives_in:
+                arrives_in = arrival
 
-        if len(to_send) != 0:
-            result = self.push_notification_service.send_push_notifications(to_send)
-            if result[0].get('success') == 0:
-                pushed_requests = []
+        return due, arrives_in
 
-        return pushed_requests
+    def push_sent(self, requests, outcomes):
+        """
+        Marks the requests pushed whose push notifications were delivered, or can never be delivered because FCM
+        rejected the device. The other requests are returned to the push scheduler after a growing delay and notify is
+        kept running, so that their notifications are sent again. The requests which have failed too many times are
+        given up and marked pushed too. (Called from PushNotificationService when the notifications have been sent.)
+
+        :param requests: list of (trip_id, request_id, stop_id, device_id)
+        :param outcomes: dict where outcomes[device_id] = PUSH_SENT, PUSH_FAILED or PUSH_INVALID
+        """
+        done = [sr[1] for sr in requests if outcomes.get(sr[3]) in (PUSH_SENT, PUSH_INVALID)]
+        retried = False
+        for sr in requests:
+            if outcomes.get(sr[3]) in (PUSH_SENT, PUSH_INVALID):
+                self.push_scheduler.done(sr[1])
+            elif self.push_scheduler.retry(*sr):
+                retried = True
+            else:
+                print("Giving up the push notification of request", sr[1])
+                done.append(sr[1])
+        if done:
+            self.db.set_pushed(done)
+        if retried:
+            thread_helper.start_do_every("PUSH", self.push_interval, self.notify)
 
     def fetch_pushable_requests(self):
         """
-        Fetches uncancelled and unpushed stoprequests from the database.
+        Fetches uncancelled and unpushed stoprequests from the database. (Called at startup, after which the push
+        scheduler keeps track of the requests, see load_pushable_requests.)
 
         :return: dict where dict where stoprequests[trip_id] = [ (request_id_1, stop_id_1, device_id_1), ... ]
         """
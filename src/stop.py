@@ -10,17 +10,82 @@ import services
 import push_notification_service
 import db
 import mqtt
+import thread_helper
+from beacon_registry import BeaconRegistry
+from http_client import HTTPClient
+from mqtt import MQTTPublisher
+from push_scheduler import PushScheduler
+from stop_requests import StopRequestCounts
+from vehicles import ActiveVehicles, VehicleWriter
 
 
 app = Flask(__name__)
 
 db = db.Database()
-push_notification_service = push_notification_service.PushNotificationService()
+vehicle_writer = VehicleWriter(db,
+                               interval=float(os.getenv('VEHICLE_WRITE_INTERVAL', 1.0)),
+                               batch_size=int(os.getenv('VEHICLE_WRITE_BATCH_SIZE', 500)),
+                               max_pending=int(os.getenv('VEHICLE_WRITE_MAX_PENDING', 10000)))
+active_vehicles = ActiveVehicles(db, vehicle_writer)
+stop_request_counts = StopRequestCounts(db)
+push_notification_service = push_notification_service.PushNotificationService(
+    workers=int(os.getenv('PUSH_WORKERS', 2)),
+    max_queue=int(os.getenv('PUSH_QUEUE_SIZE', 1000)),
+    retries=int(os.getenv('PUSH_RETRIES', 3)),
+    backoff=float(os.getenv('PUSH_BACKOFF', 1.0)))
+push_scheduler = PushScheduler(lead_time=services.PUSH_LEAD_TIME,
+                               min_interval=float(os.getenv('PUSH_MIN_INTERVAL', 5)),
+                               max_rate=float(os.getenv('PUSH_MAX_QUERY_RATE', 10)),
+                               retry_delay=float(os.getenv('PUSH_RETRY_DELAY', 5)),
+                               max_retries=int(os.getenv('PUSH_MAX_RETRIES', 5)))
+http_client = HTTPClient(pool_size=int(os.getenv('HTTP_POOL_SIZE', 10)),
+                         timeout=float(os.getenv('HTTP_TIMEOUT', 10)),
+                         retries=int(os.getenv('HTTP_RETRIES', 3)),
+                         backoff_factor=float(os.getenv('HTTP_BACKOFF', 0.3)))
+beacon_registry = BeaconRegistry(http_client, os.getenv('BEACON_SNAPSHOT_DIR'))
+publisher = MQTTPublisher("epsilon.fixme.fi", qos=int(os.getenv('MQTT_QOS', 0)))
 digitransitAPIService = services.DigitransitAPIService(db,
                                                        push_notification_service,
-                                                       'http://api.digitransit.space/routing/v1/routers/hsl/index/graphql')
-                                                       #'http://api.digitransit.fi/routing/v1/routers/hsl/index/graphql')
-mqtt = mqtt.MQTT(db)
+                                                       'http://api.digitransit.space/routing/v1/routers/hsl/index/graphql',
+                                                       #'http://api.digitransit.fi/routing/v1/routers/hsl/index/graphql',
+                                                       max_workers=int(os.getenv('UPSTREAM_WORKERS', 10)),
+                                                       batch_queries=os.getenv('BATCH_QUERIES', 'FALSE') == 'TRUE',
+                                                       http_client=http_client,
+                                                       stop_cache_size=int(os.getenv('STOP_CACHE_SIZE', 1000)),
+                                                       stop_cache_ttl=float(os.getenv('STOP_CACHE_TTL', 15)),
+                                                       beacon_registry=beacon_registry,
+                                                       fuzzy_trip_cache_size=int(os.getenv('FUZZY_TRIP_CACHE_SIZE', 1000)),
+                                                       trip_cache_size=int(os.getenv('TRIP_CACHE_SIZE', 1000)),
+                                                       trip_cache_ttl=float(os.getenv('TRIP_CACHE_TTL', 10)),
+                                                       trip_batch_size=int(os.getenv('TRIP_BATCH_SIZE', 50)),
+                                                       active_vehicles=active_vehicles,
+                                                       publisher=publisher,
+                                                       publish_window=float(os.getenv('STOP_REQUEST_PUBLISH_WINDOW', 0.5)),
+                                                       stop_request_counts=stop_request_counts,
+                                                       push_scheduler=push_scheduler,
+                                                       push_interval=float(os.getenv('PUSH_INTERVAL', 1)))
+digitransitAPIService.start()
+mqtt = mqtt.MQTT(active_vehicles)
+
+# Loads the stop index before serving and keeps it up to date, 0 disables the index
+stop_index_refresh = float(os.getenv('STOP_INDEX_REFRESH', 3600))
+if stop_index_refresh > 0:
+    digitransitAPIService.refresh_stop_index()
+    thread_helper.start_do_every("STOP_INDEX", stop_index_refresh, digitransitAPIService.refresh_stop_index,
+                                 delay=stop_index_refresh)
+
+# Resumes the push notifications of the requests made before a restart
+digitransitAPIService.load_pushable_requests()
+
+# Loads the beacon files before serving and checks them for changes
+beacon_refresh = float(os.getenv('BEACON_REFRESH', 600))
+beacon_registry.refresh()
+thread_helper.start_do_every("BEACONS", beacon_refresh, beacon_registry.refresh, delay=beacon_refresh)
+
+# Drops the stop requests of finished trips from memory
+stop_request_expiry = float(os.getenv('STOP_REQUEST_EXPIRY_INTERVAL', 600))
+thread_helper.start_do_every("STOP_REQUESTS", stop_request_expiry, stop_request_counts.expire,
+                             delay=stop_request_expiry)
 
 
 @app.route('/')
@@ -145,5 +210,16 @@ def routes():
     resp.mimetype = 'application/json'
     return resp
 
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    metrics = digitransitAPIService.get_metrics()
+    resp = make_response(json.dumps(metrics))
+    resp.mimetype = 'application/json'
+    return resp
+
 if __name__ == '__main__':
-    serve(app, host='0.0.0.0', port=os.getenv('PORT', 5000))
+    try:
+        serve(app, host='0.0.0.0', port=os.getenv('PORT', 5000))
+    finally:
+        thread_helper.shutdown()
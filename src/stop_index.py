@@ -0,0 +1,86 @@
+import math
+
+EARTH_RADIUS = 6371010  # meters, same as Digitransit uses for distances
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    :return: great-circle distance between two points in meters
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+class StopIndex:
+    """
+    Grid of stop locations for answering radius searches in-process. Stops are bucketed into rows of cell_size meters
+    and each row into cells of about cell_size meters, so a search only measures the distance to the stops in the cells
+    overlapping the search radius.
+    """
+
+    def __init__(self, cell_size=500):
+        """
+        :param cell_size: height and approximate width of a cell in meters
+        """
+        self.row_degrees = cell_size / METERS_PER_DEGREE
+        self.cells = {}
+        self.size = 0
+
+    @property
+    def loaded(self):
+        return self.size > 0
+
+    def load(self, stops):
+        """
+        Replaces the indexed stops. The new grid is built aside and swapped in at once, so searches running concurrently
+        see either the old or the new stops.
+
+        :param stops: list of dicts containing gtfsId, lat, lon and vehicleType
+        """
+        cells = {}
+        for stop in stops:
+            if stop.get('lat') is None or stop.get('lon') is None:
+                continue
+            row = self.row(stop['lat'])
+            cells.setdefault((row, self.column(row, stop['lon'])), []).append(stop)
+        self.cells, self.size = cells, sum(len(c) for c in cells.values())
+
+    def row(self, lat):
+        return math.floor(lat / self.row_degrees)
+
+    def column(self, row, lon):
+        return math.floor(lon / self.column_degrees(row))
+
+    def column_degrees(self, row):
+        # Longitude degrees get shorter towards the poles, so the cells of a row are as wide in meters as at its equator
+        # side edge or wider
+        lat = min(abs(row), abs(row + 1)) * self.row_degrees
+        return self.row_degrees / max(math.cos(math.radians(lat)), 0.01)
+
+    def find(self, lat, lon, radius):
+        """
+        Finds stops within radius of the point defined by lat and lon.
+
+        :param lat: latitude
+        :param lon: longitude
+        :param radius: radius in meters
+        :return: list of the same form as the edges of a stopsByRadius query:
+            [ {"node": {"distance": X, "stop": {"gtfsId": Y, "lat": Z, ...}}}, ... ]
+        """
+        cells = self.cells
+        lat_radius = radius / METERS_PER_DEGREE
+        # Widest longitude span of the radius, reached at the edge of the circle nearest to a pole
+        pole_lat = min(abs(lat) + lat_radius, 89.9)
+        lon_radius = lat_radius / max(math.cos(math.radians(pole_lat)), 0.01)
+
+        edges = []
+        for row in range(self.row(lat - lat_radius), self.row(lat + lat_radius) + 1):
+            for column in range(self.column(row, lon - lon_radius), self.column(row, lon + lon_radius) + 1):
+                for stop in cells.get((row, column), ()):
+                    d = distance(lat, lon, stop['lat'], stop['lon'])
+                    if d <= radius:
+                        edges.append({'node': {'distance': int(round(d)), 'stop': stop}})
+        edges.sort(key=lambda e: e['node']['distance'])
+        return edges
@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+
+# Seconds a request is counted for. Trips of a service day may run until early next morning, so by then the trip of
+# the request has finished.
+MAX_REQUEST_AGE = 30 * 60 * 60
+
+
+class StopRequestCounts:
+    """
+    Number of passengers waiting at each stop of a trip, i.e. uncanceled stop requests by trip and stop. Kept in memory
+    and updated as requests are made and canceled. Until load has been called, a trip is counted from the database when
+    it's first needed. A trip is dropped by expire once max_age seconds have passed since its latest request.
+    """
+
+    def __init__(self, db, max_age=MAX_REQUEST_AGE):
+        """
+        :param db: Database
+        :param max_age: seconds a request is counted for
+        """
+        self.db = db
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.counts = {}  # trip_id -> {stop_id: passengers}
+        self.last_request = {}  # trip_id -> time of the latest request of the trip
+        self.loaded = False
+
+    def load(self):
+        """
+        Replaces the counts with the uncanceled requests made within max_age seconds in the database.
+        """
+        counts = {}
+        last_request = {}
+        for trip_id, stop_id, passengers, req_time in self.db.get_request_counts(self.max_age):
+            counts.setdefault(trip_id, {})[stop_id] = passengers
+            last_request[trip_id] = max(last_request.get(trip_id, 0), req_time)
+        with self.lock:
+            self.counts = counts
+            self.last_request = last_request
+            self.loaded = True
+
+    def expire(self):
+        """
+        Drops the trips whose latest request was made more than max_age seconds ago. (Called periodically from stop.py,
+        see thread_helper.py)
+        """
+        oldest = time.time() - self.max_age
+        with self.lock:
+            for trip_id in [t for t, req_time in self.last_request.items() if req_time < oldest]:
+                del self.last_request[trip_id]
+                self.counts.pop(trip_id, None)
+
+    def add(self, trip_id, stop_id):
+        """
+        Counts a request stored to the database.
+        """
+        with self.lock:
+            self.last_request[trip_id] = time.time()
+            if self.load_trip(trip_id):
+                return
+            stops = self.counts[trip_id]
+            stops[stop_id] = stops.get(stop_id, 0) + 1
+
+    def remove(self, trip_id, stop_id):
+        """
+        Uncounts a request canceled in the database.
+        """
+        with self.lock:
+            if self.load_trip(trip_id):
+                return
+            stops = self.counts[trip_id]
+            if stops.get(stop_id, 0) > 1:
+                stops[stop_id] -= 1
+            else:
+                stops.pop(stop_id, None)
+            if not stops and self.loaded:
+                del self.counts[trip_id]
+                self.last_request.pop(trip_id, None)
+
+    def load_trip(self, trip_id):
+        # Caller must hold self.lock. Returns True if the trip was counted from the database, which already includes
+        # the change being counted.
+        if trip_id in self.counts:
+            return False
+        self.last_request.setdefault(trip_id, time.time())
+        if self.loaded:
+            self.counts[trip_id] = {}
+            return False
+        stops = {}
+        for row in self.db.get_requests(trip_id):
+            stops[row[0]] = stops.get(row[0], 0) + 1
+        self.counts[trip_id] = stops
+        return True
+
+    def get(self, trip_id):
+        """
+        :param trip_id: trip id
+        :return: dict containing stop_ids of all stoprequests related to trip_id:
+            {"stop_ids": [ {"id": stop_id, "passengers": X}, ... ]}
+        """
+        with self.lock:
+            if trip_id not in self.counts and not self.loaded:
+                self.load_trip(trip_id)
+            stops = self.counts.get(trip_id, {})
+            return {"stop_ids": [{"id": stop_id, "passengers": passengers} for stop_id, passengers in stops.items()]}
+
+    def stats(self):
+        with self.lock:
+            return {'trips': len(self.counts), 'passengers': sum(sum(s.values()) for s in self.counts.values())}
+
+
+class StopRequestPublisher:
+    """
+    Publishes the stop requests of changed trips to 'stoprequests/<trip_id>'. Changes made within window seconds of the
+    first change are collected, and each changed trip is published once per window with its latest counts. Nothing is
+    published before start has been called.
+    """
+
+    def __init__(self, publisher, counts, window=0.5):
+        """
+        :param publisher: MQTTPublisher
+        :param counts: StopRequestCounts
+        :param window: seconds the changes are collected before publishing
+        """
+        self.publisher = publisher
+        self.counts = counts
+        self.window = window
+        self.changed = set()
+        self.condition = threading.Condition()
+        self.changes = 0
+        self.publishes = 0
+
+        self.thread = threading.Thread(target=self.run, name="stop-request-publisher", daemon=True)
+
+    def start(self):
+        """
+        Starts publishing the changes from a background thread.
+        """
+        self.thread.start()
+
+    def trip_changed(self, trip_id):
+        """
+        Marks the stop requests of a trip changed, to be published at the end of the current window.
+        """
+        with self.condition:
+            self.changed.add(trip_id)
+            self.changes += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.changed:
+                    self.condition.wait()
+            time.sleep(self.window)
+            with self.condition:
+                changed, self.changed = self.changed, set()
+
+            for trip_id in changed:
+                try:
+                    self.publisher.publish("stoprequests/" + trip_id, json.dumps(self.counts.get(trip_id)))
+                except Exception as e:
+                    print("Publishing stop requests of %s failed: %s" % (trip_id, e))
+            with self.condition:
+                self.publishes += len(changed)
+
+    def stats(self):
+        """
+        :return: dict containing the number of changes and the number of publishes they were coalesced into
+        """
+        with self.condition:
+            return {'changes': self.changes, 'publishes': self.publishes}
@@ -15,4 +15,15 @@ class MockPushService():
                              {'message_id': '0:1479802488914973c8bc1d27f9fd7ecd'},
                              {'message_id': '0:1479802488915364c8bc1d27f9fd7ecd'}],
                  'failure': 0,
-                 'success': len(registration_ids)}]
\ No newline at end of file
+                 'success': len(registration_ids)}]
+
+    def queue_push_notifications(self, registration_ids, callback=None):
+        if callback:
+            callback({registration_id: 'sent' for registration_id in registration_ids})
+
+    def queue_error_push_notifications(self, registration_ids, error_message, callback=None):
+        if callback:
+            callback({registration_id: 'sent' for registration_id in registration_ids})
+
+    def stats(self):
+        return {}
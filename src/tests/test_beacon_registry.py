@@ -0,0 +1,66 @@
+import shutil
+import tempfile
+import unittest
+import beacon_registry
+
+CSV = "Major,Minor,Stop,Vehicle\n3911,61612,V6147,\n43118,56850,,1234\n"
+
+
+class MockResponse():
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception("HTTP %d" % self.status_code)
+
+
+class MockHTTPClient():
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+class TestBeaconRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_beacons_are_loaded_once(self):
+        http = MockHTTPClient([MockResponse(200, CSV, {'ETag': '"1"'})])
+        registry = beacon_registry.BeaconRegistry(http, self.snapshot_dir)
+
+        self.assertEqual(registry.get_stop_beacon(3911, 61612)['Stop'], 'V6147')
+        self.assertEqual(registry.get_stop_beacon("3911", "61612")['Stop'], 'V6147')
+        self.assertEqual(registry.get_stop_beacon(0, 0), None)
+        self.assertEqual(len(http.requests), 1)
+
+    def test_refresh_is_conditional(self):
+        http = MockHTTPClient([MockResponse(200, CSV, {'ETag': '"1"'}), MockResponse(304)])
+        registry = beacon_registry.BeaconRegistry(http, self.snapshot_dir)
+
+        registry.busses.refresh()
+        registry.busses.refresh()
+        self.assertEqual(http.requests[1], {'If-None-Match': '"1"'})
+        self.assertEqual(registry.get_bus_beacon(43118, 56850)['Vehicle'], '1234')
+
+    def test_snapshot_is_used_when_download_fails(self):
+        http = MockHTTPClient([MockResponse(200, CSV)])
+        beacon_registry.BeaconRegistry(http, self.snapshot_dir).busses.refresh()
+
+        http = MockHTTPClient([MockResponse(500)])
+        registry = beacon_registry.BeaconRegistry(http, self.snapshot_dir)
+        self.assertEqual(registry.get_bus_beacon(43118, 56850)['Vehicle'], '1234')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import threading
+import unittest
+from unittest import mock
+import cache
+
+
+class SignalingEvent(threading.Event):
+    """
+    Event setting waiting when the given number of threads have waited for it.
+    """
+
+    def __init__(self, waiters):
+        super().__init__()
+        self.waiters = waiters
+        self.lock = threading.Lock()
+        self.waiting = threading.Event()
+
+    def wait(self, timeout=None):
+        with self.lock:
+            self.waiters -= 1
+            if self.waiters == 0:
+                self.waiting.set()
+        return super().wait(timeout)
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.TTLCache(maxsize=2, ttl=10)
+
+    def test_get_and_set(self):
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("a", "default"), "default")
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['size'], 1)
+
+    def test_contains(self):
+        self.cache.set("a", 1)
+        self.assertTrue("a" in self.cache)
+        self.assertFalse("b" in self.cache)
+        self.assertEqual(self.cache.stats()['hits'], 0)
+        self.assertEqual(self.cache.stats()['misses'], 0)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    @mock.patch('cache.time.monotonic')
+    def test_entries_expire(self, monotonic):
+        monotonic.return_value = 100
+        self.cache.set("a", 1)
+
+        monotonic.return_value = 109
+        self.assertEqual(self.cache.get("a"), 1)
+
+        monotonic.return_value = 110
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_get_or_load_is_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "value"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.cache.get_or_load("a", loader)))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        # The followers wait for the load of the leader
+        done = self.cache.loading["a"].done = SignalingEvent(3)
+        followers = [threading.Thread(target=lambda: results.append(self.cache.get_or_load("a", loader)))
+                     for i in range(3)]
+        for f in followers:
+            f.start()
+        self.assertTrue(done.waiting.wait(5))
+        self.assertEqual(self.cache.stats()['coalesced'], 3)
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+
+        self.assertEqual(results, ["value"] * 4)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.get("a"), "value")
+
+    def test_get_or_load_does_not_store_none(self):
+        self.assertEqual(self.cache.get_or_load("a", lambda: None), None)
+        self.assertEqual(self.cache.get_or_load("a", lambda: 1, ttl=5), 1)
+        self.assertEqual(self.cache.stats()['size'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
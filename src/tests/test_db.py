@@ -0,0 +1,134 @@
+import os
+import threading
+import unittest
+from unittest import mock
+import db
+
+
+class MockCursor():
+    def __init__(self, conn):
+        self.connection = conn
+        self.closed = False
+
+    def execute(self, sql, values=None):
+        self.connection.executed.append((sql, values))
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+class MockConnection():
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+        self.prepared = set()
+        self.executed = []
+        self.cursors = []
+
+    def cursor(self):
+        self.cursors.append(MockCursor(self))
+        return self.cursors[-1]
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class MockPool():
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.connections = [MockConnection() for i in range(maxconn)]
+        self.returned = []
+
+    def getconn(self):
+        return self.connections.pop()
+
+    def putconn(self, conn, close=False):
+        self.returned.append(conn)
+        self.connections.append(conn)
+
+
+class SignalingSemaphore():
+    """
+    Semaphore setting blocked when a thread has to wait for it.
+    """
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.blocked = threading.Event()
+
+    def acquire(self):
+        if not self.semaphore.acquire(blocking=False):
+            self.blocked.set()
+            self.semaphore.acquire()
+        return True
+
+    def release(self):
+        self.semaphore.release()
+
+
+@mock.patch.dict(os.environ, {'DB_POOL_MAX': '1'})
+@mock.patch('db.migrate.migrate', return_value=[])
+@mock.patch('db.psycopg2.pool.ThreadedConnectionPool', MockPool)
+class TestDatabase(unittest.TestCase):
+
+    def test_transaction_is_committed(self, migrate):
+        database = db.Database()
+        with database.transaction() as cur:
+            cur.execute("INSERT")
+
+        conn = database.pool.returned[-1]
+        self.assertEqual(conn.commits, 1)
+        self.assertTrue(conn.cursors[-1].closed)
+        self.assertEqual(database.stats()['in_use'], 0)
+
+    def test_connection_is_returned_after_exception(self, migrate):
+        database = db.Database()
+        with self.assertRaises(ValueError):
+            with database.transaction():
+                raise ValueError()
+
+        conn = database.pool.returned[-1]
+        self.assertEqual(conn.commits, 0)
+        self.assertTrue(conn.cursors[-1].closed)
+        self.assertEqual(conn.rollbacks, 2)  # Also rolled back after migrating
+        self.assertEqual(database.stats()['in_use'], 0)
+
+    def test_waits_for_connection_when_pool_is_exhausted(self, migrate):
+        database = db.Database()
+        database.available = SignalingSemaphore(database.available)
+        borrowed = []
+
+        with database.cursor():
+            waiter = threading.Thread(target=lambda: borrowed.append(database.get_vehicles()))
+            waiter.start()
+            self.assertTrue(database.available.blocked.wait(5))
+            self.assertEqual(database.stats()['waiting'], 1)
+            self.assertEqual(database.stats()['in_use'], 1)
+        waiter.join(5)
+
+        stats = database.stats()
+        self.assertEqual(len(borrowed), 1)
+        self.assertEqual(stats['max_in_use'], 1)
+        self.assertEqual(stats['acquired'], 3)
+        self.assertGreater(stats['max_wait_ms'], 0)
+
+    def test_statements_are_prepared_once_per_connection(self, migrate):
+        database = db.Database()
+        database.set_pushed([1, 2])
+        database.set_pushed([3])
+
+        conn = database.pool.returned[-1]
+        self.assertEqual(conn.executed, [
+            ("PREPARE set_pushed (integer[]) AS UPDATE request SET pushed = true WHERE id = ANY($1)", None),
+            ("EXECUTE set_pushed (%s)", ([1, 2],)),
+            ("EXECUTE set_pushed (%s)", ([3],))])
+        self.assertEqual(conn.commits, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+import migrate
+
+
+class MockCursor():
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, values=None):
+        if sql == "fail":
+            raise Exception("syntax error")
+        self.conn.executed.append(sql)
+
+    def fetchall(self):
+        return [(version,) for version in self.conn.applied]
+
+
+class MockConnection():
+    def __init__(self, applied):
+        self.applied = applied
+        self.executed = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return MockCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        for name, sql in [("002_second.sql", "second"), ("001_first.sql", "first"), ("010_tenth.sql", "tenth"),
+                          ("README", "not a migration")]:
+            with open(os.path.join(self.dir.name, name), "w") as f:
+                f.write(sql)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_find_migrations(self):
+        versions = [version for version, path in migrate.find_migrations(self.dir.name)]
+        self.assertEqual(versions, [1, 2, 10])
+
+    def test_only_pending_migrations_are_applied_in_order(self):
+        conn = MockConnection(applied=[1])
+        self.assertEqual(migrate.migrate(conn, self.dir.name), [2, 10])
+
+        migrations = [sql for sql in conn.executed if sql in ("first", "second", "tenth")]
+        self.assertEqual(migrations, ["second", "tenth"])
+        self.assertTrue(conn.executed[0].startswith("SELECT pg_advisory_lock"))
+        self.assertTrue(conn.executed[-1].startswith("SELECT pg_advisory_unlock"))
+
+    def test_failed_migration_is_rolled_back(self):
+        with open(os.path.join(self.dir.name, "003_broken.sql"), "w") as f:
+            f.write("fail")
+        conn = MockConnection(applied=[1, 2])
+
+        self.assertRaises(Exception, migrate.migrate, conn, self.dir.name)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertNotIn("tenth", conn.executed)
+        self.assertTrue(conn.executed[-1].startswith("SELECT pg_advisory_unlock"))
+
+
+if __name__ == '__main__':
+    unittest.main()
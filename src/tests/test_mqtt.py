@@ -0,0 +1,65 @@
+import threading
+import unittest
+from unittest import mock
+import paho.mqtt.client as paho
+import mqtt
+
+
+class MockClient():
+    """
+    Client whose connection is left half-open: the first publish fails without a disconnect, and the server
+    acknowledges only the second reconnect.
+    """
+
+    def __init__(self):
+        self.failures = 1
+        self.reconnects = 0
+        self.reconnect_threads = set()
+        self.disconnected = threading.Event()
+        self.published = []
+        self.delivered = threading.Event()
+
+    def connect_async(self, host, port, keepalive):
+        pass
+
+    def loop_forever(self, retry_first_connection=False):
+        if self.reconnects != 1:
+            self.on_connect(self, None, {}, 0)
+        self.disconnected.wait()
+        self.disconnected.clear()
+        self.on_disconnect(self, None, 0)
+
+    def disconnect(self):
+        self.disconnected.set()
+
+    def reconnect(self):
+        self.reconnects += 1
+        self.reconnect_threads.add(threading.current_thread())
+
+    def publish(self, topic, payload, qos=0):
+        if self.failures:
+            self.failures -= 1
+            return paho.MQTT_ERR_NO_CONN, None
+        self.published.append((topic, payload))
+        self.delivered.set()
+        return paho.MQTT_ERR_SUCCESS, 1
+
+
+@mock.patch('mqtt.mqtt.Client', MockClient)
+class TestMQTTPublisher(unittest.TestCase):
+
+    def test_publisher_reconnects_after_failed_publish(self):
+        publisher = mqtt.MQTTPublisher("localhost", reconnect_timeout=0.05)
+        publisher.start()
+        publisher.publish("stoprequests/trip_1", "{}")
+
+        self.assertTrue(publisher.client.delivered.wait(5))
+        self.assertEqual(publisher.client.published, [("stoprequests/trip_1", "{}")])
+        self.assertEqual(publisher.client.reconnects, 2)
+        self.assertEqual(publisher.stats()['reconnects'], 2)
+        # Only the network thread touches the connection
+        self.assertEqual(publisher.client.reconnect_threads, {publisher.network_thread})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import unittest
+from unittest import mock
+import push_notification_service
+
+
+class MockFCMNotification():
+    def __init__(self, api_key=None):
+        self.calls = []
+        self.failures = 0
+        self.errors = {}  # registration_id -> list of errors returned for it before succeeding
+
+    def notify_multiple_devices(self, registration_ids=None, data_message=None):
+        self.calls.append(registration_ids)
+        if self.failures:
+            self.failures -= 1
+            raise Exception("FCM server error")
+        results = []
+        for registration_id in registration_ids:
+            errors = self.errors.get(registration_id)
+            results.append({'error': errors.pop(0)} if errors else {'message_id': registration_id})
+        return [{'success': sum(1 for r in results if 'message_id' in r),
+                 'failure': sum(1 for r in results if 'error' in r),
+                 'results': results}]
+
+
+class MockResponse():
+    def __init__(self, registration_ids):
+        self.status_code = 200
+        self.headers = {}
+        self.registration_ids = registration_ids
+
+    def json(self):
+        return {'multicast_id': 1, 'success': len(self.registration_ids), 'failure': 0, 'canonical_ids': 0,
+                'results': [{'message_id': registration_id} for registration_id in self.registration_ids]}
+
+
+class TestPushNotificationService(unittest.TestCase):
+
+    def setUp(self):
+        self.fcm = MockFCMNotification()
+        patcher = mock.patch('push_notification_service.FCMNotification', lambda api_key=None: self.fcm)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = push_notification_service.PushNotificationService(workers=1, retries=2, backoff=0.01)
+
+    def test_requests_are_chunked(self):
+        registration_ids = [str(i) for i in range(2500)]
+        responses = self.service.send_push_notifications(registration_ids)
+
+        self.assertEqual([len(c) for c in self.fcm.calls], [1000, 1000, 500])
+        self.assertEqual(sum(r['success'] for r in responses), 2500)
+        self.assertEqual(self.service.stats()['batches'], 3)
+
+    def test_failed_request_is_retried(self):
+        self.fcm.failures = 2
+        responses = self.service.send_push_notifications(["a"])
+
+        self.assertEqual(responses[0]['success'], 1)
+        self.assertEqual(self.service.stats()['retried'], 2)
+
+    def test_failure_after_retries_is_reported_to_callback(self):
+        self.fcm.failures = 3
+        done = threading.Event()
+        results = []
+
+        def callback(outcomes):
+            results.append(outcomes)
+            done.set()
+
+        self.service.queue_push_notifications(["a"], callback)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, [{"a": push_notification_service.PUSH_FAILED}])
+        self.assertEqual(self.service.stats()['failures'], 3)
+
+    def test_outcome_of_every_device_is_reported(self):
+        self.fcm.errors = {"b": ["Unavailable"], "c": ["NotRegistered"],
+                                        "d": ["Unavailable", "Unavailable", "Unavailable"]}
+        outcomes = self.service.deliver(["a", "b", "c", "d"], push_notification_service.PUSH_MESSAGE)
+
+        self.assertEqual(outcomes, {"a": push_notification_service.PUSH_SENT,
+                                    "b": push_notification_service.PUSH_SENT,
+                                    "c": push_notification_service.PUSH_INVALID,
+                                    "d": push_notification_service.PUSH_FAILED})
+        # Only the devices with transient errors are retried
+        self.assertEqual(self.fcm.calls, [["a", "b", "c", "d"], ["b", "d"], ["d"]])
+        self.assertEqual(self.service.stats()['retried_devices'], 3)
+
+
+
+@mock.patch.dict(os.environ, {'FCM_API_KEY': 'key'})
+class TestPushNotificationServiceWithPyFCM(unittest.TestCase):
+
+    def setUp(self):
+        self.service = push_notification_service.PushNotificationService(workers=1, retries=0)
+
+    def post(self, url, headers=None, data=None, **kwargs):
+        return MockResponse(json.loads(data)['registration_ids'])
+
+    def test_every_delivery_gets_its_own_results(self):
+        with mock.patch('pyfcm.baseapi.requests.post', self.post):
+            first = self.service.deliver(["a", "b"], push_notification_service.PUSH_MESSAGE)
+            second = self.service.deliver(["c", "d"], push_notification_service.PUSH_MESSAGE)
+
+        self.assertEqual(first, {"a": push_notification_service.PUSH_SENT, "b": push_notification_service.PUSH_SENT})
+        self.assertEqual(second, {"c": push_notification_service.PUSH_SENT, "d": push_notification_service.PUSH_SENT})
+
+
+if __name__ == '__main__':
+    unittest.main()
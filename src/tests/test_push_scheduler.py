@@ -0,0 +1,148 @@
+import unittest
+from unittest import mock
+import push_scheduler
+
+
+class TestPushScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('push_scheduler.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = push_scheduler.PushScheduler(lead_time=120, min_interval=5, max_rate=0)
+
+    def test_new_request_is_checked_right_away(self):
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.add("trip_1", 2, "stop_2", "device_2")
+
+        due = self.scheduler.due()
+        self.assertEqual(list(due.keys()), ["trip_1"])
+        self.assertEqual(sorted(due["trip_1"]), [(1, "stop_1", "device_1"), (2, "stop_2", "device_2")])
+        # Not checked again until its next check is scheduled
+        self.assertEqual(self.scheduler.due(), {})
+
+    def test_trip_is_checked_more_often_as_arrival_nears(self):
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.due()
+
+        delays = []
+        for arrives_in in (3600, 1000, 400, 240, 124):
+            self.scheduler.checked("trip_1", arrives_in)
+            check_time = self.scheduler.next_check["trip_1"]
+            delays.append(check_time - self.now)
+            self.now = check_time
+            self.assertEqual(list(self.scheduler.due().keys()), ["trip_1"])
+
+        self.assertEqual(delays, [300, 60, 15, 5, 5])
+
+    def test_trip_is_not_checked_before_its_time(self):
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.add("trip_2", 2, "stop_2", "device_2")
+        self.scheduler.due()
+        self.scheduler.checked("trip_1", 600)
+        self.scheduler.checked("trip_2", 200)
+
+        self.now += 30
+        self.assertEqual(list(self.scheduler.due().keys()), ["trip_2"])
+
+    def test_new_request_brings_check_forward(self):
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.due()
+        self.scheduler.checked("trip_1", 3600)
+
+        self.scheduler.add("trip_1", 2, "stop_2", "device_2")
+        self.assertEqual(len(self.scheduler.due()["trip_1"]), 2)
+
+    def test_removed_requests_are_not_checked(self):
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.remove("trip_1", 1)
+
+        self.assertEqual(self.scheduler.due(), {})
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(self.scheduler.stats(), {'trips': 0, 'requests': 0, 'retrying': 0, 'checks': 0,
+                                                   'throttled': 0, 'given_up': 0})
+
+    def test_check_is_not_scheduled_past_due_time(self):
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.due()
+        self.scheduler.checked("trip_1", 1250)
+
+        self.assertEqual(self.scheduler.next_check["trip_1"] - self.now, 300)
+        self.assertEqual(self.scheduler.interval(150), 5)
+        self.assertEqual(self.scheduler.interval(330), 15)
+        self.assertEqual(self.scheduler.interval(700), 60)
+
+    def test_checks_are_limited_by_budget(self):
+        scheduler = push_scheduler.PushScheduler(max_rate=2)
+        for i in range(5):
+            scheduler.add("trip_%d" % i, i, "stop", "device")
+
+        self.assertEqual(sorted(scheduler.due().keys()), ["trip_0", "trip_1"])
+        self.assertEqual(scheduler.due(), {})
+        self.now += 1
+        self.assertEqual(sorted(scheduler.due().keys()), ["trip_2", "trip_3"])
+        self.now += 10
+        scheduler.add("trip_5", 5, "stop", "device")
+        scheduler.add("trip_6", 6, "stop", "device")
+        # Unused budget accumulates only up to one second's worth
+        self.assertEqual(sorted(scheduler.due().keys()), ["trip_4", "trip_5"])
+        self.assertEqual(scheduler.stats()['throttled'], 4)
+
+    def test_budget_is_spent_per_query(self):
+        scheduler = push_scheduler.PushScheduler(max_rate=2)
+        for i in range(50):
+            scheduler.add("trip_%d" % i, i, "stop", "device")
+
+        # The 50 trips are fetched with one query of 50 trips
+        self.assertEqual(len(scheduler.due(batch_size=50)), 50)
+        for i in range(50, 101):
+            scheduler.add("trip_%d" % i, i, "stop", "device")
+        self.assertEqual(len(scheduler.due(batch_size=50)), 50)
+        self.assertEqual(list(scheduler.due(batch_size=50).keys()), [])
+        self.assertEqual(scheduler.stats()['checks'], 100)
+
+    def test_cached_trips_do_not_spend_budget(self):
+        scheduler = push_scheduler.PushScheduler(max_rate=1)
+        for i in range(3):
+            scheduler.add("trip_%d" % i, i, "stop", "device")
+
+        self.assertEqual(len(scheduler.due(cached=lambda trip_id: trip_id != "trip_1")), 3)
+        scheduler.add("trip_3", 3, "stop", "device")
+        self.assertEqual(scheduler.due(cached=lambda trip_id: False), {})
+
+    def test_failed_request_is_retried_with_growing_delay(self):
+        self.scheduler.max_retries = 2
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.due()
+        self.scheduler.remove("trip_1", 1)
+
+        self.assertTrue(self.scheduler.retry("trip_1", 1, "stop_1", "device_1"))
+        self.assertEqual(len(self.scheduler), 1)
+        self.now += 4
+        self.assertEqual(self.scheduler.due(), {})
+        self.now += 1
+        self.assertEqual(self.scheduler.due(), {"trip_1": [(1, "stop_1", "device_1")]})
+        self.scheduler.remove("trip_1", 1)
+
+        self.assertTrue(self.scheduler.retry("trip_1", 1, "stop_1", "device_1"))
+        self.now += 9
+        self.assertEqual(self.scheduler.due(), {})
+        self.now += 1
+        self.assertEqual(list(self.scheduler.due().keys()), ["trip_1"])
+        self.scheduler.remove("trip_1", 1)
+
+        self.assertFalse(self.scheduler.retry("trip_1", 1, "stop_1", "device_1"))
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(self.scheduler.stats()['given_up'], 1)
+
+    def test_load_replaces_requests(self):
+        self.scheduler.add("trip_1", 1, "stop_1", "device_1")
+        self.scheduler.load({"trip_2": [(2, "stop_2", "device_2"), (3, "stop_3", "device_3")]})
+
+        self.assertEqual(list(self.scheduler.due().keys()), ["trip_2"])
+        self.assertEqual(len(self.scheduler), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
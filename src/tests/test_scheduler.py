@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+import scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def test_job_runs_given_number_of_iterations(self):
+        done = threading.Event()
+        calls = []
+
+        def job():
+            calls.append(1)
+            if len(calls) == 3:
+                done.set()
+
+        self.assertTrue(self.scheduler.start("JOB", 0.01, job, iterations=3))
+        self.assertTrue(done.wait(5))
+        while self.scheduler.is_running("JOB"):
+            time.sleep(0.01)
+        self.assertEqual(len(calls), 3)
+
+    def test_job_is_not_started_twice(self):
+        release = threading.Event()
+        self.assertTrue(self.scheduler.start("JOB", 0.01, release.wait))
+        self.assertFalse(self.scheduler.start("JOB", 0.01, release.wait))
+        release.set()
+
+    def test_slow_run_is_not_overlapped(self):
+        running = []
+        overlaps = []
+        done = threading.Event()
+
+        def job():
+            overlaps.append(len(running))
+            running.append(1)
+            time.sleep(0.05)
+            running.pop()
+            if len(overlaps) == 3:
+                done.set()
+
+        self.scheduler.start("JOB", 0.01, job)
+        self.assertTrue(done.wait(5))
+        self.scheduler.stop("JOB")
+        self.assertEqual(overlaps[:3], [0, 0, 0])
+
+    def test_job_stopping_itself_keeps_running_if_started_meanwhile(self):
+        calls = []
+        second_run = threading.Event()
+
+        def job():
+            calls.append(1)
+            if len(calls) == 1:
+                # Work is added while the job finds none
+                self.scheduler.start("PUSH", 0.01, job)
+            else:
+                second_run.set()
+            self.scheduler.stop("PUSH")
+
+        self.scheduler.start("PUSH", 0.01, job)
+        self.assertTrue(second_run.wait(5))
+        while self.scheduler.is_running("PUSH"):
+            time.sleep(0.01)
+        self.assertEqual(len(calls), 2)
+
+    def test_slow_job_does_not_delay_other_jobs(self):
+        release = threading.Event()
+        fast_ran = threading.Event()
+
+        self.scheduler.start("BEACONS", 0.01, release.wait)
+        self.scheduler.start("PUSH", 0.01, fast_ran.set, delay=0.05)
+        try:
+            self.assertTrue(fast_ran.wait(5))
+            self.assertTrue(self.scheduler.stats()["BEACONS"]["running"])
+        finally:
+            release.set()
+
+    def test_thread_is_started_by_first_job(self):
+        self.assertIsNone(self.scheduler.thread)
+        self.scheduler.start("JOB", 0.01, lambda: None)
+        self.assertTrue(self.scheduler.thread.is_alive())
+
+    def test_failing_job_keeps_running(self):
+        calls = []
+        done = threading.Event()
+
+        def job():
+            calls.append(1)
+            if len(calls) == 2:
+                done.set()
+            raise ValueError("failed")
+
+        self.scheduler.start("JOB", 0.01, job)
+        self.assertTrue(done.wait(5))
+        self.assertGreaterEqual(self.scheduler.stats()["JOB"]["failures"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
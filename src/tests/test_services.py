@@ -1,14 +1,50 @@
+import datetime
+import threading
 import unittest
+from unittest import mock
+from freezegun import freeze_time
 import services
 import db
+import push_notification_service
+import push_scheduler
 import tests.mock.mock_push_service as mock_push_service
 
 
+class MockBeaconRegistry():
+    def __init__(self, busses):
+        self.busses = busses
+
+    def get_bus_beacon(self, major, minor):
+        return self.busses.get((major, minor))
+
+
+class FailingPushService():
+    def __init__(self):
+        self.sent = []
+
+    def queue_push_notifications(self, registration_ids, callback=None):
+        self.sent.append(registration_ids)
+        callback({registration_id: push_notification_service.PUSH_FAILED for registration_id in registration_ids})
+
+
+class MockDatabase():
+    def __init__(self):
+        self.pushed = []
+
+    def set_pushed(self, request_ids):
+        self.pushed.append(request_ids)
+
+
 class TestDigitransitAPIService(unittest.TestCase):
 
     def setUp(self):
         self.digitransitAPIService = services.DigitransitAPIService(db.Database(), mock_push_service.MockPushService(), 'http://localhost:11111')
 
+    def test_constructing_service_starts_no_threads(self):
+        threads = threading.active_count()
+        services.DigitransitAPIService(db.Database(), mock_push_service.MockPushService(), 'http://localhost:11111')
+        self.assertEqual(threading.active_count(), threads)
+
     def test_get_stops(self):
         stops = self.digitransitAPIService.get_stops(60.203978, 24.9633573, 160)
         self.assertTrue("stops" in stops)
@@ -28,6 +64,16 @@ class TestDigitransitAPIService(unittest.TestCase):
         schedule = stop_data["schedule"]
         self.assertNotEqual(len(schedule), 0)
 
+    def test_get_stops_batched(self):
+        batched_service = services.DigitransitAPIService(db.Database(), mock_push_service.MockPushService(),
+                                                         'http://localhost:11111', batch_queries=True)
+        with freeze_time(datetime.datetime.now()):
+            stops = self.digitransitAPIService.get_stops(60.203978, 24.9633573, 160)
+            batched_stops = batched_service.get_stops(60.203978, 24.9633573, 160)
+
+        self.assertNotEqual(len(batched_stops["stops"][0]["stop"]["schedule"]), 0)
+        self.assertEqual(batched_stops, stops)
+
     def test_get_stops_with_beacon_fake(self):
         stops = self.digitransitAPIService.get_stops_with_beacon(1234, 5678)
         self.assertTrue("stops" in stops)
@@ -114,6 +160,44 @@ class TestDigitransitAPIService(unittest.TestCase):
         self.assertTrue(1 in result)
         self.assertTrue(2 in result)
 
+    @mock.patch('thread_helper.start_do_every')
+    @mock.patch('thread_helper.stop_do_every')
+    def test_failed_push_is_retried_with_backoff(self, stop_do_every, start_do_every):
+        now = [1000.0]
+        push_service = FailingPushService()
+        database = MockDatabase()
+        with mock.patch('push_scheduler.time.monotonic', lambda: now[0]):
+            scheduler = push_scheduler.PushScheduler(max_rate=0, retry_delay=10, max_retries=1)
+            service = services.DigitransitAPIService(database, push_service, 'http://localhost:11111',
+                                                     push_scheduler=scheduler)
+            scheduler.add("trip_id_1", 1, "stop_id", "device_id")
+
+            service.notify()
+            self.assertEqual(push_service.sent, [["device_id"]])
+            # Not sent again before the delay has passed, but PUSH keeps running
+            now[0] += 5
+            service.notify()
+            self.assertEqual(push_service.sent, [["device_id"]])
+            stop_do_every.assert_not_called()
+
+            now[0] += 5
+            service.notify()
+            self.assertEqual(push_service.sent, [["device_id"], ["device_id"]])
+            # Given up after max_retries
+            self.assertEqual(database.pushed, [[1]])
+            self.assertEqual(len(scheduler), 0)
+            stop_do_every.assert_called_with("PUSH")
+
+    def test_fetch_trips(self):
+        self.digitransitAPIService.trip_batch_size = 2
+        trips = self.digitransitAPIService.fetch_trips(["trip_id_1", "trip_id_2", "trip_id_3", "INVALID"])
+
+        self.assertEqual(trips["trip_id_1"].trip_id, "trip_id_1")
+        self.assertEqual(trips["trip_id_3"].trip_id, "trip_id_3")
+        self.assertIsNone(trips["INVALID"])
+        # Served from the cache
+        self.assertIs(self.digitransitAPIService.fetch_trip("trip_id_2"), trips["trip_id_2"])
+
     def test_fetch_single_fuzzy_trip(self):
         result = self.digitransitAPIService.fetch_single_fuzzy_trip("1", 1, "20161204", 1000)
 
@@ -127,6 +211,26 @@ class TestDigitransitAPIService(unittest.TestCase):
         self.assertEqual(len(result['vehicles']), 1)
         self.assertEqual(result['vehicles'][0]['error'], 'Invalid major and/or minor')
 
+    def test_get_busses_with_beacon_looks_up_each_bus_once(self):
+        self.digitransitAPIService.beacon_registry = MockBeaconRegistry({(1, 1): {'Vehicle': '1001'},
+                                                                         (1, 2): {'Vehicle': '1001'},
+                                                                         (2, 1): {'Vehicle': '1002'}})
+        buses = {'1001': {'trip_id': 'trip_1', 'destination': 'test', 'line': '55'}, '1002': None}
+        major_minor = [{"major": 1, "minor": 1}, {"major": 0, "minor": 0}, {"major": 2, "minor": 1},
+                       {"major": 1, "minor": 2}]
+
+        with mock.patch.object(self.digitransitAPIService, 'get_bus_by_vehicle', side_effect=buses.get) as lookup:
+            result = self.digitransitAPIService.get_busses_with_beacon(major_minor)
+
+        self.assertEqual(sorted(call[0][0] for call in lookup.call_args_list), ['1001', '1002'])
+        self.assertEqual(result['vehicles'], [
+            {'trip_id': 'trip_1', 'destination': 'test', 'line': '55', 'major': 1, 'minor': 1, 'vehicle_type': 3},
+            {'error': 'Invalid major and/or minor', 'major': 0, 'minor': 0},
+            {'error': 'No realtime data from the bus', 'major': 2, 'minor': 1},
+            {'trip_id': 'trip_1', 'destination': 'test', 'line': '55', 'major': 1, 'minor': 2, 'vehicle_type': 3}])
+        # The beacons of the same bus don't share the result dict
+        self.assertIsNot(result['vehicles'][0], result['vehicles'][3])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,6 @@
 import unittest
 import stop
+import json
 import datetime
 from datetime import date
 from freezegun import freeze_time
@@ -25,5 +26,13 @@ class TestStopRoutes(unittest.TestCase):
         response = self.app.post('/stoprequests', data=json_string, content_type='application/json')
         self.assertEqual(response.status_code, 200)
 
+    def test_metrics_get(self):
+        self.app.get('/stops?lat=60.203978&lon=24.9633573')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        metrics = json.loads(response.data.decode('utf-8'))
+        self.assertTrue("http" in metrics)
+        self.assertTrue(metrics["http"]["requests"] > 0)
+
 if __name__ == '__main__':
     unittest.main()
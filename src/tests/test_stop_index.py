@@ -0,0 +1,37 @@
+import random
+import unittest
+import stop_index
+
+
+class TestStopIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = stop_index.StopIndex(cell_size=200)
+
+    def test_not_loaded_when_empty(self):
+        self.assertFalse(self.index.loaded)
+        self.index.load([{'gtfsId': 'HSL:1', 'lat': None, 'lon': None, 'vehicleType': 3}])
+        self.assertFalse(self.index.loaded)
+
+    def test_distance(self):
+        # Kumpula: 0.001 degrees of latitude is about 111 meters
+        self.assertEqual(round(stop_index.distance(60.203978, 24.9633573, 60.204978, 24.9633573)), 111)
+
+    def test_find_matches_linear_search(self):
+        rng = random.Random(1)
+        stops = [{'gtfsId': 'HSL:%d' % i, 'lat': 60.15 + rng.random() * 0.1, 'lon': 24.85 + rng.random() * 0.2,
+                  'vehicleType': 3} for i in range(2000)]
+        self.index.load(stops)
+        self.assertTrue(self.index.loaded)
+
+        for radius in (50, 160, 1000):
+            found = self.index.find(60.2, 24.95, radius)
+            expected = [s['gtfsId'] for s in stops if stop_index.distance(60.2, 24.95, s['lat'], s['lon']) <= radius]
+            self.assertEqual(sorted(e['node']['stop']['gtfsId'] for e in found), sorted(expected))
+
+            distances = [e['node']['distance'] for e in found]
+            self.assertEqual(distances, sorted(distances))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+import stop_requests
+
+
+class MockDatabase():
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def get_requests(self, trip_id):
+        self.queries += 1
+        return [(stop_id,) for t, stop_id in self.rows if t == trip_id]
+
+    def get_request_counts(self, max_age):
+        self.queries += 1
+        counts = {}
+        for row in self.rows:
+            counts[row] = counts.get(row, 0) + 1
+        return [(trip_id, stop_id, passengers, time.time()) for (trip_id, stop_id), passengers in counts.items()]
+
+
+class MockPublisher():
+    def __init__(self):
+        self.messages = []
+        self.published = threading.Event()
+
+    def publish(self, topic, payload):
+        self.messages.append((topic, json.loads(payload)))
+        self.published.set()
+
+
+class TestStopRequestCounts(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MockDatabase([("trip_1", "stop_1"), ("trip_1", "stop_1")])
+        self.counts = stop_requests.StopRequestCounts(self.db)
+
+    def test_trip_is_counted_from_database_once(self):
+        self.db.rows.append(("trip_1", "stop_2"))
+        self.counts.add("trip_1", "stop_2")
+        self.counts.add("trip_1", "stop_2")
+        self.counts.remove("trip_1", "stop_1")
+
+        self.assertEqual(self.db.queries, 1)
+        self.assertEqual(sorted(self.counts.get("trip_1")["stop_ids"], key=lambda s: s["id"]),
+                         [{"id": "stop_1", "passengers": 1}, {"id": "stop_2", "passengers": 2}])
+
+    def test_stop_is_removed_when_last_request_is_canceled(self):
+        self.counts.get("trip_1")
+        self.counts.remove("trip_1", "stop_1")
+        self.counts.remove("trip_1", "stop_1")
+        self.assertEqual(self.counts.get("trip_1"), {"stop_ids": []})
+
+    def test_loaded_counts_need_no_queries(self):
+        self.db.rows.append(("trip_2", "stop_3"))
+        self.counts.load()
+        self.counts.add("trip_3", "stop_1")
+        self.counts.remove("trip_2", "stop_3")
+
+        self.assertEqual(self.counts.get("trip_1"), {"stop_ids": [{"id": "stop_1", "passengers": 2}]})
+        self.assertEqual(self.counts.get("trip_2"), {"stop_ids": []})
+        self.assertEqual(self.counts.get("trip_3"), {"stop_ids": [{"id": "stop_1", "passengers": 1}]})
+        self.assertEqual(self.counts.get("trip_4"), {"stop_ids": []})
+        self.assertEqual(self.db.queries, 1)
+        self.assertEqual(self.counts.stats(), {'trips': 2, 'passengers': 3})
+
+    def test_finished_trips_are_dropped(self):
+        counts = stop_requests.StopRequestCounts(self.db, max_age=100)
+        counts.load()
+        now = time.time()
+        with mock.patch('stop_requests.time.time', return_value=now + 50):
+            counts.add("trip_2", "stop_1")
+        with mock.patch('stop_requests.time.time', return_value=now + 120):
+            counts.expire()
+
+        self.assertEqual(counts.get("trip_1"), {"stop_ids": []})
+        self.assertEqual(counts.get("trip_2"), {"stop_ids": [{"id": "stop_1", "passengers": 1}]})
+        self.assertEqual(counts.stats(), {'trips': 1, 'passengers': 1})
+
+
+class TestStopRequestPublisher(unittest.TestCase):
+
+    def test_changes_within_window_are_published_once(self):
+        counts = stop_requests.StopRequestCounts(MockDatabase([]))
+        counts.load()  # No requests were made before, so every request is counted
+        publisher = MockPublisher()
+        coalescing_publisher = stop_requests.StopRequestPublisher(publisher, counts, window=0.2)
+        coalescing_publisher.start()
+
+        for i in range(5):
+            counts.add("trip_1", "stop_1")
+            coalescing_publisher.trip_changed("trip_1")
+
+        self.assertTrue(publisher.published.wait(5))
+        self.assertEqual(publisher.messages,
+                         [("stoprequests/trip_1", {"stop_ids": [{"id": "stop_1", "passengers": 5}]})])
+        self.assertEqual(coalescing_publisher.stats(), {'changes': 5, 'publishes': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+import trip
+
+
+class TestTrip(unittest.TestCase):
+
+    def setUp(self):
+        self.trip = trip.Trip({"gtfsId": "trip_id_1", "stoptimesForDate": [
+            {"serviceDay": 1479765600, "realtimeArrival": 60, "stop": {"gtfsId": "stop_1"}},
+            {"serviceDay": 1479765600, "realtimeArrival": 120, "stop": {"gtfsId": "stop_2"}},
+            {"serviceDay": 1479765600, "realtimeArrival": 180, "stop": {"gtfsId": "stop_1"}}]})
+
+    def test_stoptimes_at(self):
+        self.assertEqual(self.trip.trip_id, "trip_id_1")
+        self.assertEqual([s['realtimeArrival'] for s in self.trip.stoptimes_at("stop_1")], [60, 180])
+        self.assertEqual([s['realtimeArrival'] for s in self.trip.stoptimes_at("stop_2")], [120])
+        self.assertEqual(self.trip.stoptimes_at("stop_3"), [])
+
+    def test_arrival_time(self):
+        stoptime = self.trip.stoptimes_at("stop_2")[0]
+        self.assertEqual(trip.Trip.arrival_time(stoptime).timestamp(), 1479765720)
+
+
+if __name__ == '__main__':
+    unittest.main()
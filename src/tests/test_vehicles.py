@@ -0,0 +1,94 @@
+import unittest
+import vehicles
+
+
+class MockDatabase():
+    def __init__(self):
+        self.rows = [("1", "trip_1"), ("2", "trip_1"), ("3", "trip_2")]
+        self.writes = []
+        self.fail = False
+
+    def get_vehicles(self):
+        return list(self.rows)
+
+    def write_vehicles(self, added, removed):
+        if self.fail:
+            raise Exception("database is down")
+        self.writes.append((added, removed))
+        for row in added:
+            if row not in self.rows:
+                self.rows.append(row)
+        for row in removed:
+            if row in self.rows:
+                self.rows.remove(row)
+
+
+class TestActiveVehicles(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MockDatabase()
+        self.vehicles = vehicles.ActiveVehicles(self.db, vehicles.VehicleWriter(self.db, interval=60))
+        self.vehicles.load()
+
+    def test_load(self):
+        self.assertTrue("trip_1" in self.vehicles)
+        self.assertTrue("trip_2" in self.vehicles)
+        self.assertFalse("trip_3" in self.vehicles)
+        self.assertEqual(self.vehicles.stats(), {'trips': 2, 'vehicles': 3})
+
+    def test_trip_is_active_until_its_last_vehicle_stops(self):
+        self.vehicles.remove("1", "trip_1")
+        self.assertTrue("trip_1" in self.vehicles)
+        self.vehicles.remove("2", "trip_1")
+        self.assertFalse("trip_1" in self.vehicles)
+
+    def test_changes_are_written_to_database(self):
+        self.vehicles.add("4", "trip_3")
+        self.vehicles.remove("3", "trip_2")
+        self.vehicles.writer.flush()
+        self.assertEqual(sorted(self.db.rows), [("1", "trip_1"), ("2", "trip_1"), ("4", "trip_3")])
+
+
+class TestVehicleWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.db = MockDatabase()
+        self.writer = vehicles.VehicleWriter(self.db, interval=60, max_pending=3)
+
+    def test_changes_are_collapsed_into_one_batch(self):
+        self.writer.add("4", "trip_3")
+        self.writer.remove("4", "trip_3")
+        self.writer.add("4", "trip_3")
+        self.writer.remove("3", "trip_2")
+        self.writer.flush()
+
+        self.assertEqual(self.db.writes, [([("4", "trip_3")], [("3", "trip_2")])])
+        stats = self.writer.stats()
+        self.assertEqual(stats['collapsed'], 2)
+        self.assertEqual(stats['written'], 2)
+        self.assertEqual(stats['batches'], 1)
+
+    def test_changes_are_dropped_when_too_many_are_pending(self):
+        for vehicle_id in ["4", "5", "6", "7"]:
+            self.writer.add(vehicle_id, "trip_3")
+        self.writer.add("4", "trip_3")
+
+        stats = self.writer.stats()
+        self.assertEqual(stats['pending'], 3)
+        self.assertEqual(stats['dropped'], 1)
+
+    def test_failed_batch_is_retried(self):
+        self.db.fail = True
+        self.writer.add("4", "trip_3")
+        self.writer.add("5", "trip_3")
+        self.assertFalse(self.writer.flush())
+
+        self.db.fail = False
+        self.writer.remove("4", "trip_3")
+        self.assertTrue(self.writer.flush())
+        self.assertEqual(self.db.writes, [([("5", "trip_3")], [("4", "trip_3")])])
+        self.assertEqual(self.writer.stats()['failures'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
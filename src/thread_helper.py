@@ -1,45 +1,30 @@
-import threading
-import os
+from scheduler import Scheduler
 
+# Runs all the periodic workers of the process, its threads are started by the first worker
+scheduler = Scheduler()
 
-def do_every(lockname, interval, worker_func, iterations=0):
+
+def start_do_every(lockname, interval, worker_func, iterations=0, delay=0):
     """
-    Calls worker_func every interval seconds for interations times (0 is eternal loop) or until envinroment variable
-    named after lockname is STOP.
+    Starts calling worker_func every interval seconds for iterations times (0 is eternal loop) or until stop_do_every
+    is called with lockname, unless a worker called lockname is already running.
 
-    :param lockname: name of envinroment variable which specifies if certain worker is running and when to stop
+    :param lockname: name of the worker, used to check if it's running and to stop it
     :param interval: interval the worker is run in seconds
     :param worker_func: worker function
     :param iterations: number of iterations, 0 means infinite
+    :param delay: seconds until the first call
+    :return: True if the worker was started, False if it was already running
     """
-    if os.environ[lockname] == 'STOP':
-        os.environ[lockname] = 'FALSE'
-        return
-    if iterations != 1:
-        threading.Timer(
-            interval,
-            do_every, [lockname, interval, worker_func, 0 if iterations == 0 else iterations - 1]
-        ).start()
-    elif iterations == 1:
-        os.environ[lockname] = 'FALSE'
+    return scheduler.start(lockname, interval, worker_func, iterations, delay)
 
-    worker_func()
 
+def stop_do_every(lockname):
+    scheduler.stop(lockname)
 
-def start_do_every(lockname, interval, worker_func, iterations=0):
-    """
-    Starts function do_every with parameters given to it unless environment variable specified by lockname is already
-    TRUE, in which case it's already running.
 
-    :param lockname: name of envinroment variable which specifies if certain worker is running and when to stop
-    :param interval: interval the worker is run in seconds
-    :param worker_func: worker function
-    :param iterations: number of iterations, 0 means infinite
+def shutdown():
     """
-    if os.getenv(lockname, 'FALSE') == 'FALSE':
-        os.environ[lockname] = 'TRUE'
-        do_every(lockname, interval, worker_func, iterations)
-
-
-def stop_do_every(lockname):
-    os.environ[lockname] = 'STOP'
\ No newline at end of file
+    Stops all workers, waiting for a call that is going on to finish.
+    """
+    scheduler.shutdown()
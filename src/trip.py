@@ -0,0 +1,33 @@
+import datetime
+
+
+class Trip:
+    """
+    Realtime stoptimes of a trip selected with TRIP_QUERY, indexed by stop id. Built once per fetched trip and shared
+    by everything looking up the arrivals of the trip.
+    """
+
+    def __init__(self, data):
+        """
+        :param data: trip data selected with TRIP_QUERY (in services.py)
+        """
+        self.trip_id = data.get('gtfsId')
+        self.stoptimes = data['stoptimesForDate']
+        self.stoptimes_by_stop = {}  # stop_id -> stoptimes, a trip may pass the same stop more than once
+        for stoptime in self.stoptimes:
+            self.stoptimes_by_stop.setdefault(stoptime['stop']['gtfsId'], []).append(stoptime)
+
+    def stoptimes_at(self, stop_id):
+        """
+        :param stop_id: stop id
+        :return: list of the stoptimes of the trip at the stop, empty if the stop isn't on the route of the trip
+        """
+        return self.stoptimes_by_stop.get(stop_id, [])
+
+    @staticmethod
+    def arrival_time(stoptime):
+        """
+        :param stoptime: stoptime of the trip
+        :return: realtime arrival as datetime
+        """
+        return datetime.datetime.fromtimestamp(stoptime['serviceDay'] + stoptime['realtimeArrival'])
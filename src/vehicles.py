@@ -0,0 +1,161 @@
+import collections
+import threading
+import time
+
+
+class VehicleWriter:
+    """
+    Writes the starts and stops of the vehicles to the database in batches from a background thread, so handling the
+    MQTT messages never waits for the database. Within a batch only the latest change of each vehicle and trip is
+    written. The thread runs once start has been called, until then the changes are only written by flush.
+    """
+
+    def __init__(self, db, interval=1.0, batch_size=500, max_pending=10000):
+        """
+        :param db: Database
+        :param interval: seconds between writes
+        :param batch_size: number of pending changes written without waiting for the interval
+        :param max_pending: maximum number of pending changes, further changes are dropped until the database catches up
+        """
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()  # (vehicle_id, trip_id) -> True if started, False if stopped
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.changes = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+
+        self.thread = threading.Thread(target=self.run, name="vehicle-writer", daemon=True)
+
+    def start(self):
+        """
+        Starts writing the changes from the background thread.
+        """
+        self.thread.start()
+
+    def add(self, vehicle_id, trip_id):
+        self.change((vehicle_id, trip_id), True)
+
+    def remove(self, vehicle_id, trip_id):
+        self.change((vehicle_id, trip_id), False)
+
+    def change(self, key, started):
+        with self.condition:
+            self.changes += 1
+            if key in self.pending:
+                self.collapsed += 1
+            elif len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.pending[key] = started
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) >= self.batch_size, timeout=self.interval)
+            if not self.flush():
+                # Give the database time to recover before retrying
+                time.sleep(self.interval)
+
+    def flush(self):
+        """
+        Writes the pending changes to the database. If writing fails, the changes are kept pending and retried with the
+        next batch.
+
+        :return: False if writing failed
+        """
+        with self.flush_lock:
+            with self.condition:
+                if not self.pending:
+                    return True
+                batch, self.pending = self.pending, collections.OrderedDict()
+
+            added = [key for key, started in batch.items() if started]
+            removed = [key for key, started in batch.items() if not started]
+            try:
+                self.db.write_vehicles(added, removed)
+            except Exception as e:
+                print("Writing vehicles failed: %s" % e)
+                with self.condition:
+                    self.failures += 1
+                    # Changes made meanwhile are newer than the failed ones
+                    for key, started in batch.items():
+                        if key not in self.pending and len(self.pending) < self.max_pending:
+                            self.pending[key] = started
+                return False
+
+            with self.condition:
+                self.written += len(batch)
+                self.batches += 1
+            return True
+
+    def stats(self):
+        """
+        :return: dict containing the number of pending, collapsed, dropped and written changes, written batches and
+            failed writes
+        """
+        with self.condition:
+            return {'pending': len(self.pending),
+                    'changes': self.changes,
+                    'collapsed': self.collapsed,
+                    'dropped': self.dropped,
+                    'written': self.written,
+                    'batches': self.batches,
+                    'failures': self.failures}
+
+
+class ActiveVehicles:
+    """
+    Trips that currently have a vehicle supporting stop requests running. Kept in memory and updated from the start and
+    stop messages of the vehicles (see mqtt.py), while the database keeps them over restarts.
+    """
+
+    def __init__(self, db, writer=None):
+        """
+        :param db: Database the vehicles are loaded from
+        :param writer: VehicleWriter writing the changes to the database, by default one writing to db
+        """
+        self.db = db
+        self.writer = writer if writer else VehicleWriter(db)
+        self.lock = threading.Lock()
+        self.vehicles_by_trip = {}  # trip_id -> set of vehicle_ids
+
+    def load(self):
+        """
+        Replaces the active vehicles with the ones stored in the database.
+        """
+        vehicles_by_trip = {}
+        for vehicle_id, trip_id in self.db.get_vehicles():
+            vehicles_by_trip.setdefault(trip_id, set()).add(vehicle_id)
+        with self.lock:
+            self.vehicles_by_trip = vehicles_by_trip
+
+    def add(self, vehicle_id, trip_id):
+        with self.lock:
+            self.vehicles_by_trip.setdefault(trip_id, set()).add(vehicle_id)
+        self.writer.add(vehicle_id, trip_id)
+
+    def remove(self, vehicle_id, trip_id):
+        with self.lock:
+            vehicles = self.vehicles_by_trip.get(trip_id)
+            if vehicles is not None:
+                vehicles.discard(vehicle_id)
+                if not vehicles:
+                    del self.vehicles_by_trip[trip_id]
+        self.writer.remove(vehicle_id, trip_id)
+
+    def __contains__(self, trip_id):
+        return trip_id in self.vehicles_by_trip
+
+    def stats(self):
+        with self.lock:
+            return {'trips': len(self.vehicles_by_trip),
+                    'vehicles': sum(len(v) for v in self.vehicles_by_trip.values())}